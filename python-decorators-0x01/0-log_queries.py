@@ -1,25 +1,261 @@
-import sqlite3
+import re
 import functools
-from datetime import datetime
+import atexit
+import inspect
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque, namedtuple
+from collections.abc import Iterator
+
+from db import get_read_pool, statements
+
+statements.register("users.all", "SELECT * FROM users")
+
+# One entry per traced call. duration_ns is wall time inside the decorated
+# function (None for unsampled calls that failed); rows is None when the
+# result has no length.
+QueryRecord = namedtuple(
+    "QueryRecord",
+    "seq timestamp fingerprint params duration_ns rows error",
+)
+
+LITERALS = re.compile(
+    r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|\bIN\s*\([^)]*\)", re.IGNORECASE
+)
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(query):
+    # Literal values and IN lists become ?, so the same statement with
+    # different values groups under one fingerprint.
+    def replace(match):
+        return "IN (?)" if match.group(0)[:2].upper() == "IN" else "?"
+    return " ".join(LITERALS.sub(replace, query).split())
+
+class QueryTrace:
+    # Callers only append a plain tuple to a bounded deque, which is atomic
+    # under the GIL, so tracing takes no lock. Fingerprints and wall-clock
+    # timestamps are worked out later, off the hot path. A background
+    # thread hands new records to the sinks in batches; records that fall
+    # off the ring before the sink thread reaches them count as `dropped`.
+    def __init__(self, capacity=10000, sample_rate=1.0, flush_interval=0.5):
+        self.ring = deque(maxlen=capacity)
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.sinks = []
+        self.dropped = 0
+        self._seq = itertools.count()
+        self._epoch = time.time() - time.perf_counter_ns() / 1e9
+        self._flushed = -1
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def record(self, query, params, started_ns, duration_ns, rows,
+               error=None):
+        self.ring.append((
+            next(self._seq), query, params, started_ns, duration_ns, rows,
+            error,
+        ))
+
+    def _materialize(self, entry):
+        seq, query, params, started_ns, duration_ns, rows, error = entry
+        return QueryRecord(
+            seq, self._epoch + started_ns / 1e9, fingerprint(str(query)),
+            params, duration_ns, rows, error,
+        )
+
+    def recent(self, count=None):
+        entries = list(self.ring.copy())
+        if count is not None:
+            entries = entries[-count:]
+        return [self._materialize(entry) for entry in entries]
+
+    def trace_stream(self, query, params, started_ns, rows):
+        # Records a streamed result once it is exhausted, fails or is
+        # closed, with the rows handed out so far.
+        count = 0
+        error = None
+        try:
+            for row in rows:
+                count += 1
+                yield row
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            close = getattr(rows, "close", None)
+            if close is not None:
+                close()
+            self.record(
+                query, params, started_ns,
+                time.perf_counter_ns() - started_ns, count, error,
+            )
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="query-trace-sink", daemon=True
+            )
+            self._thread.start()
+        return sink
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            entries = [
+                entry for entry in self.ring.copy()
+                if entry[0] > self._flushed
+            ]
+            if not entries:
+                return
+            self.dropped += entries[0][0] - self._flushed - 1
+            self._flushed = entries[-1][0]
+            batch = [self._materialize(entry) for entry in entries]
+            for sink in self.sinks:
+                try:
+                    sink(batch)
+                except Exception:
+                    logging.getLogger(__name__).exception(
+                        "query trace sink %r failed", sink
+                    )
+
+class FileSink:
+    # Appends one JSON object per record.
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, records):
+        with open(self.path, "a") as handle:
+            handle.writelines(
+                json.dumps(record._asdict()) + "\n" for record in records
+            )
+
+class LoggingSink:
+    # Emits each record through a logger, with its fields in `extra`, so
+    # any logging handler can be attached.
+    def __init__(self, logger="query_trace", level=logging.INFO):
+        if isinstance(logger, str):
+            logger = logging.getLogger(logger)
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, records):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        for record in records:
+            self.logger.log(
+                self.level, "%s (%.3f ms, %s rows)", record.fingerprint,
+                record.duration_ns / 1e6, record.rows,
+                extra={"query": record._asdict()},
+            )
+
+query_trace = QueryTrace()
+atexit.register(query_trace.flush)
+
+def count_params(args, kwargs):
+    params = kwargs.get('params', args[1] if len(args) > 1 else None)
+    return len(params) if isinstance(params, (tuple, list, dict)) else 0
+
+def log_queries(func=None, *, trace=None):
+    if func is None:
+        return functools.partial(log_queries, trace=trace)
+
+    if inspect.iscoroutinefunction(func):
+        # Duration covers the whole await, including time the coroutine
+        # spends suspended.
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            tracer = query_trace if trace is None else trace
+            query = kwargs.get('query', args[0] if args else None)
+            sampled = (tracer.sample_rate >= 1.0
+                       or random.random() < tracer.sample_rate)
+            started = time.perf_counter_ns()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                tracer.record(
+                    query, count_params(args, kwargs), started,
+                    time.perf_counter_ns() - started if sampled else None,
+                    None, f"{type(e).__name__}: {e}",
+                )
+                raise
+            if sampled:
+                tracer.record(
+                    query, count_params(args, kwargs), started,
+                    time.perf_counter_ns() - started,
+                    len(result) if isinstance(result, (list, tuple)) else None,
+                )
+            return result
+        return async_wrapper
 
-def log_queries(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        query = kwargs.get('query', args[0] if args else None)
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{timestamp}] Executing query: {query}")
-        return func(*args, **kwargs)
+        tracer = query_trace if trace is None else trace
+        rate = tracer.sample_rate
+        if rate < 1.0 and random.random() >= rate:
+            # Unsampled calls are not timed; errors are still recorded.
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                tracer.record(
+                    kwargs.get('query', args[0] if args else None),
+                    count_params(args, kwargs), time.perf_counter_ns(),
+                    None, None, f"{type(e).__name__}: {e}",
+                )
+                raise
+        started = time.perf_counter_ns()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            tracer.record(
+                kwargs.get('query', args[0] if args else None),
+                count_params(args, kwargs), started,
+                time.perf_counter_ns() - started, None,
+                f"{type(e).__name__}: {e}",
+            )
+            raise
+        duration = time.perf_counter_ns() - started
+        # Exact list/tuple first: the Iterator check is an ABC lookup.
+        if type(result) is list or type(result) is tuple:
+            rows = len(result)
+        elif isinstance(result, Iterator):
+            # Timed until the stream is drained or closed.
+            return tracer.trace_stream(
+                kwargs.get('query', args[0] if args else None),
+                count_params(args, kwargs), started, result,
+            )
+        else:
+            rows = len(result) if isinstance(result, (list, tuple)) else None
+        # record() inlined: this is the path every sampled call takes.
+        params = kwargs.get('params', args[1] if len(args) > 1 else None)
+        tracer.ring.append((
+            next(tracer._seq), kwargs.get('query', args[0] if args else None),
+            len(params) if isinstance(params, (tuple, list, dict)) else 0,
+            started, duration, rows, None,
+        ))
+        return result
     return wrapper
 
 @log_queries
 def fetch_all_users(query):
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute(query)
-    results = cursor.fetchall()
-    conn.close()
-    return results
+    # SQL matching a registered statement is counted under its name.
+    with get_read_pool().connection() as conn:
+        return statements.fetchall(conn, query)
+
+@log_queries
+def stream_all_users(query, chunk_size=1000):
+    with get_read_pool().connection() as conn:
+        yield from statements.stream(conn, query, chunk_size=chunk_size)
 
 if __name__ == "__main__":
     users = fetch_all_users(query="SELECT * FROM users")
-    print("Users:", users)
\ No newline at end of file
+    print("Users:", users)
+    print("Trace:", query_trace.recent())
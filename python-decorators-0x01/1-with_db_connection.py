@@ -1,22 +1,11 @@
-import sqlite3
-import functools
+from db import read_only, statements, with_db_connection
 
-def with_db_connection(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        conn = sqlite3.connect('users.db')
-        try:
-            result = func(conn, *args, **kwargs)
-            return result
-        finally:
-            conn.close()
-    return wrapper
+statements.register("users.by_id", "SELECT * FROM users WHERE id = ?")
 
 @with_db_connection
+@read_only
 def get_user_by_id(conn, user_id):
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    return cursor.fetchone()
+    return statements.fetchone(conn, "users.by_id", (user_id,))
 
 if __name__ == "__main__":
     print("User with ID 1:", get_user_by_id(user_id=1))
\ No newline at end of file
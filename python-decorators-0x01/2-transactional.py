@@ -1,20 +1,209 @@
-import sqlite3
 import functools
+import inspect
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
 
-def with_db_connection(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        conn = sqlite3.connect('users.db')
+import db
+from db import with_db_connection
+
+# Per connection (by id, since plain sqlite3 connections take no attributes
+# or weak references): how many transactional calls are running on it, and
+# the GroupCommit batch it is collecting for, if any.
+_depth = {}
+_batches = {}
+_savepoint_ids = itertools.count()
+
+def savepoint(conn, func, args, kwargs):
+    # Runs func inside a SAVEPOINT of the open transaction, so a failure
+    # undoes only its own writes.
+    if not conn.in_transaction:
+        # A SAVEPOINT outside a transaction starts one that RELEASE would
+        # commit; BEGIN leaves the commit to the outer caller.
+        conn.execute("BEGIN")
+    name = f"sp_{next(_savepoint_ids)}"
+    conn.execute(f"SAVEPOINT {name}")
+    try:
+        result = func(conn, *args, **kwargs)
+    except BaseException:
+        conn.execute(f"ROLLBACK TO {name}")
+        conn.execute(f"RELEASE {name}")
+        raise
+    conn.execute(f"RELEASE {name}")
+    return result
+
+async def asavepoint(conn, func, args, kwargs):
+    # savepoint() for aiosqlite connections.
+    if not conn.in_transaction:
+        await conn.execute("BEGIN")
+    name = f"sp_{next(_savepoint_ids)}"
+    await conn.execute(f"SAVEPOINT {name}")
+    try:
+        result = await func(conn, *args, **kwargs)
+    except BaseException:
+        await conn.execute(f"ROLLBACK TO {name}")
+        await conn.execute(f"RELEASE {name}")
+        raise
+    await conn.execute(f"RELEASE {name}")
+    return result
+
+class GroupCommit:
+    # Collects the writes of many transactional calls on one connection into
+    # a single transaction, committed once max_batch calls are pending or
+    # the oldest has waited max_delay seconds. Each call runs in its own
+    # savepoint and gets a Future that resolves after the group commits.
+    #
+    # As a context block, @transactional functions called with conn inside
+    # it join the batch and return their Future instead of a result:
+    #
+    #     with GroupCommit(conn) as batch:
+    #         futures = [set_email(conn, user_id, email)
+    #                    for user_id, email in changes]
+    def __init__(self, conn, max_batch=100, max_delay=0.05):
+        self.conn = conn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = []
+        self.commits = 0
+        self._started = None
+
+    def __enter__(self):
+        _batches[id(self.conn)] = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        del _batches[id(self.conn)]
+        self.flush()
+
+    def remaining(self):
+        return max(0.0, self._started + self.max_delay - time.monotonic())
+
+    def run(self, func, args, kwargs, future=None):
+        future = Future() if future is None else future
+        if not self.pending:
+            self._started = time.monotonic()
+        key = id(self.conn)
+        _depth[key] = _depth.get(key, 0) + 1
         try:
-            result = func(conn, *args, **kwargs)
-            return result
+            result = savepoint(self.conn, func, args, kwargs)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            self.pending.append((future, result))
         finally:
+            _depth[key] -= 1
+            if not _depth[key]:
+                del _depth[key]
+        if len(self.pending) >= self.max_batch or not self.remaining():
+            self.flush()
+        return future
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        try:
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            for future, _ in pending:
+                future.set_exception(e)
+            return
+        if pending:
+            self.commits += 1
+        for future, result in pending:
+            future.set_result(result)
+
+class BatchWriter:
+    # Group commit across threads: calls from any thread are queued to one
+    # writer thread, which owns its own connection and batches them.
+    def __init__(self, max_batch=100, max_delay=0.05, connect=db.connect):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._connect = connect
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="batch-writer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def transactional(self, func):
+        # Decorated calls are queued and return a Future; func still takes
+        # the connection as its first argument.
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.submit(func, *args, **kwargs)
+        return wrapper
+
+    def _run(self):
+        conn = self._connect()
+        batch = GroupCommit(conn, self.max_batch, self.max_delay)
+        try:
+            while True:
+                timeout = batch.remaining() if batch.pending else None
+                try:
+                    job = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    batch.flush()
+                    continue
+                if job is None:
+                    break
+                future, func, args, kwargs = job
+                if future.set_running_or_notify_cancel():
+                    batch.run(func, args, kwargs, future)
+        finally:
+            batch.flush()
             conn.close()
-    return wrapper
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
 
 def transactional(func):
+    if inspect.iscoroutinefunction(func):
+        # Same nesting rules on an aiosqlite connection. GroupCommit and
+        # BatchWriter batch sync calls only.
+        @functools.wraps(func)
+        async def async_wrapper(conn, *args, **kwargs):
+            key = id(conn)
+            if _depth.get(key):
+                _depth[key] += 1
+                try:
+                    return await asavepoint(conn, func, args, kwargs)
+                finally:
+                    _depth[key] -= 1
+            _depth[key] = 1
+            try:
+                result = await func(conn, *args, **kwargs)
+                await conn.commit()
+                return result
+            except Exception as e:
+                await conn.rollback()
+                raise e
+            finally:
+                del _depth[key]
+        async_wrapper.__transactional__ = True
+        return async_wrapper
+
     @functools.wraps(func)
     def wrapper(conn, *args, **kwargs):
+        key = id(conn)
+        if _depth.get(key):
+            # Nested call: the outermost transactional owns the commit.
+            _depth[key] += 1
+            try:
+                return savepoint(conn, func, args, kwargs)
+            finally:
+                _depth[key] -= 1
+        batch = _batches.get(key)
+        if batch is not None:
+            return batch.run(func, args, kwargs)
+        _depth[key] = 1
         try:
             result = func(conn, *args, **kwargs)
             conn.commit()
@@ -22,14 +211,20 @@ def transactional(func):
         except Exception as e:
             conn.rollback()
             raise e
+        finally:
+            del _depth[key]
+    # Keeps with_db_connection from sending func to a read-only replica.
+    wrapper.__transactional__ = True
     return wrapper
 
 @with_db_connection
 @transactional
 def update_user_email(conn, user_id, new_email):
     cursor = conn.cursor()
-    cursor.execute("UPDATE users SET email = ? WHERE id = ?", (new_email, user_id))
+    cursor.execute(
+        "UPDATE users SET email = ? WHERE id = ?", (new_email, user_id)
+    )
 
 if __name__ == "__main__":
     update_user_email(user_id=1, new_email="new_alice@example.com")
-    print("Email updated successfully!")
\ No newline at end of file
+    print("Email updated successfully!")
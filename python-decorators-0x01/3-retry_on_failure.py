@@ -1,39 +1,169 @@
 import time
 import sqlite3
 import functools
+import asyncio
+import inspect
+import logging
+import random
+import threading
 
-def with_db_connection(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        conn = sqlite3.connect('users.db')
-        try:
-            result = func(conn, *args, **kwargs)
-            return result
-        finally:
-            conn.close()
-    return wrapper
-
-def retry_on_failure(retries=3, delay=2):
+from collections.abc import Iterator
+
+from db import prime, read_only, statements, with_db_connection
+
+statements.register("users.all", "SELECT * FROM users")
+
+# Primary result codes worth retrying: another connection holds a lock
+# that will be released. Anything else (syntax errors, constraint
+# violations, a missing table) fails the same way every time. The
+# sqlite3 error-code constants only exist from Python 3.11.
+RETRYABLE_CODES = frozenset((
+    getattr(sqlite3, "SQLITE_BUSY", 5), getattr(sqlite3, "SQLITE_LOCKED", 6)
+))
+RETRYABLE_MESSAGES = ("database is locked", "database table is locked",
+                      "database is busy")
+
+log = logging.getLogger(__name__)
+
+class CircuitOpen(sqlite3.OperationalError):
+    pass
+
+def is_retryable(error):
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        # Extended codes (e.g. SQLITE_BUSY_SNAPSHOT) keep the primary code
+        # in the low byte.
+        return code & 0xFF in RETRYABLE_CODES
+    message = str(error).lower()
+    return any(text in message for text in RETRYABLE_MESSAGES)
+
+def backoff(attempt, base, max_delay):
+    # "Full jitter": a uniform delay up to the exponential cap, so callers
+    # that failed together do not retry together.
+    return random.uniform(0, min(max_delay, base * 2 ** attempt))
+
+class RetryBudget:
+    # Token bucket shared by every decorated function. Each call that
+    # succeeds without retrying earns `ratio` tokens and each retry spends
+    # one, so retries stay a bounded fraction of traffic. After `threshold`
+    # consecutive calls give up on a retryable error the circuit opens and
+    # calls fail fast for `cooldown` seconds; the first call after that is
+    # let through as a trial.
+    def __init__(self, ratio=0.1, max_tokens=10.0, threshold=5,
+                 cooldown=10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.tokens = max_tokens
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            # Half-open: admit this caller and hold the rest until it
+            # reports back.
+            self.opened_at = time.monotonic()
+            return True
+
+    def allow_retry(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def succeeded(self, retried):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            if not retried:
+                self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+retry_budget = RetryBudget()
+
+def retry_on_failure(retries=3, delay=2, max_delay=30.0, budget=None):
+    # retries is the total number of attempts and delay the base of the
+    # exponential backoff. Coroutine functions get a wrapper that sleeps
+    # with asyncio.sleep, so waiting never blocks the event loop.
     def decorator(func):
+        limiter = retry_budget if budget is None else budget
+
+        def check_circuit():
+            if not limiter.allow_call():
+                raise CircuitOpen(
+                    f"{func.__qualname__}: too many retryable failures, "
+                    f"not calling for {limiter.cooldown}s"
+                )
+
+        def give_up(error, attempt):
+            if not is_retryable(error):
+                return True
+            if attempt == retries - 1 or not limiter.allow_retry():
+                limiter.failed()
+                return True
+            log.warning("Retry %d/%d after error: %s", attempt + 1, retries,
+                        error)
+            return False
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                check_circuit()
+                for attempt in range(retries):
+                    try:
+                        result = await func(*args, **kwargs)
+                    except sqlite3.Error as e:
+                        if give_up(e, attempt):
+                            raise
+                        await asyncio.sleep(backoff(attempt, delay, max_delay))
+                    else:
+                        limiter.succeeded(attempt > 0)
+                        return result
+            return async_wrapper
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            check_circuit()
             for attempt in range(retries):
                 try:
-                    return func(*args, **kwargs)
+                    result = func(*args, **kwargs)
+                    if isinstance(result, Iterator):
+                        # A stream can be retried until its first row has
+                        # been handed out, so pull that row inside the loop.
+                        result = prime(result)
                 except sqlite3.Error as e:
-                    if attempt == retries - 1:
+                    if give_up(e, attempt):
                         raise
-                    print(f"Retry {attempt + 1}/{retries} after error: {e}")
-                    time.sleep(delay)
+                    time.sleep(backoff(attempt, delay, max_delay))
+                else:
+                    limiter.succeeded(attempt > 0)
+                    return result
         return wrapper
     return decorator
 
 @with_db_connection
+@read_only
 @retry_on_failure(retries=3, delay=1)
 def fetch_users_with_retry(conn):
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users")
-    return cursor.fetchall()
+    return statements.fetchall(conn, "users.all")
+
+@with_db_connection
+@read_only
+@retry_on_failure(retries=3, delay=1)
+def stream_users_with_retry(conn, chunk_size=1000):
+    yield from statements.stream(conn, "users.all", chunk_size=chunk_size)
 
 if __name__ == "__main__":
     print("Users:", fetch_users_with_retry())
\ No newline at end of file
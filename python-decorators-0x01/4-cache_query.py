@@ -1,30 +1,410 @@
-import sqlite3
 import functools
+import asyncio
+import contextlib
+import inspect
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
 
-query_cache = {}
+from db import (
+    ANY_TABLE, TrackedConnection, database_path, defer_connection, on_commit,
+    read_only, statements, with_db_connection
+)
 
-def cache_query(func):
-    @functools.wraps(func)
-    def wrapper(conn, query, *args, **kwargs):
-        if query in query_cache:
-            print("Using cached result")
-            return query_cache[query]
-        print("Executing and caching query")
-        result = func(conn, query, *args, **kwargs)
-        query_cache[query] = result
-        return result
-    return wrapper
-
-def with_db_connection(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        conn = sqlite3.connect('users.db')
+# Every live QueryCache, so a commit can invalidate all of them.
+caches = weakref.WeakSet()
+
+def estimate_size(value):
+    # Rough deep size of a query result (lists/tuples of scalars), used to
+    # keep the cache under its memory budget.
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(estimate_size(item) for item in value)
+    elif isinstance(value, dict):
+        size += sum(
+            estimate_size(key) + estimate_size(item)
+            for key, item in value.items()
+        )
+    return size
+
+def freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(
+            sorted((key, freeze(item)) for key, item in value.items())
+        )
+    return value
+
+class Flight:
+    # One in-progress execution of a cache miss, shared by every caller
+    # that misses on the same key while it runs. Threads block in wait();
+    # coroutines await wait_async(), which never blocks the event loop.
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._error = None
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def resolve(self, result):
+        self._result = result
+        self._finish()
+
+    def fail(self, error):
+        self._error = error
+        self._finish()
+
+    def _outcome(self):
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def wait(self):
+        self._done.wait()
+        return self._outcome()
+
+    async def wait_async(self):
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(
+                lambda: done.done() or done.set_result(None)
+            )
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(wake)
+            else:
+                done.set_result(None)
+        await done
+        return self._outcome()
+
+class QueryCache:
+    # Expired entries are kept for stale_ttl more seconds, so callers can be
+    # served the old result while one of them refreshes it. Invalidated
+    # entries are never served stale.
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024, ttl=300.0,
+                 stale_ttl=60.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # (path, table) -> keys of entries that read it, and the version at
+        # which the table was last written; a path on its own records the
+        # last write that could not be tracked to its tables.
+        self._dependents = {}
+        self._written_at = {}
+        self._version = 0
+        caches.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        found, stale, value = self._lookup(key)
+        return found and not stale, None if stale else value
+
+    def _lookup(self, key):
+        # Returns (found, stale, value).
+        with self._lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is not None and entry[2] + self.stale_ttl <= now:
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None or entry[2] <= now:
+                self.misses += 1
+                return entry is not None, True, entry and entry[0]
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, False, entry[0]
+
+    def _join(self, key):
+        # Returns (leader, flight) for a caller that missed on key.
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight()
+                return True, flight
+            return False, flight
+
+    def _land(self, key, flight, value=None, error=None):
+        if error is None:
+            flight.resolve(value)
+        else:
+            flight.fail(error)
+        with self._lock:
+            del self._flights[key]
+
+    def _count_follower(self, found):
+        with self._lock:
+            if found:
+                self.stale_hits += 1
+            else:
+                self.coalesced += 1
+
+    def fetch(self, key, compute):
+        # Single flight: the first caller to miss on a key runs compute()
+        # and stores the result; callers that miss while it runs wait for
+        # that result, or get the stale entry if there is one.
+        found, stale, value = self._lookup(key)
+        if found and not stale:
+            return value
+        leader, flight = self._join(key)
+        if not leader:
+            self._count_follower(found)
+            return value if found else flight.wait()
+        try:
+            value = compute()
+        except BaseException as e:
+            self._land(key, flight, error=e)
+            raise
+        self._land(key, flight, value)
+        return value
+
+    async def afetch(self, key, compute):
+        # fetch() for coroutines; compute() returns an awaitable. Flights
+        # are shared with sync callers, so threads and tasks coalesce too.
+        found, stale, value = self._lookup(key)
+        if found and not stale:
+            return value
+        leader, flight = self._join(key)
+        if not leader:
+            self._count_follower(found)
+            return value if found else await flight.wait_async()
         try:
-            result = func(conn, *args, **kwargs)
+            value = await compute()
+        except BaseException as e:
+            self._land(key, flight, error=e)
+            raise
+        self._land(key, flight, value)
+        return value
+
+    def version(self):
+        return self._version
+
+    def set(self, key, value, ttl=None, path=None, tables=None, since=None):
+        # tables=None means the read could not be tracked, so any write to
+        # the database drops the entry. A result computed before version
+        # `since` is not stored if one of its tables was written meanwhile.
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        if tables is None:
+            tables = (ANY_TABLE,)
+        depends = frozenset((path, table) for table in tables)
+        with self._lock:
+            if since is not None and (
+                self._written_at.get(path, -1) >= since
+                or any(
+                    self._written_at.get(dependency, -1) >= since
+                    for dependency in depends
+                )
+            ):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires_at, depends)
+            self._bytes += size
+            for dependency in depends:
+                self._dependents.setdefault(dependency, set()).add(key)
+            # Least recently used entries go first once either bound is hit.
+            while (len(self._entries) > self.max_entries
+                   or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _, depends = self._entries.pop(key)
+        self._bytes -= size
+        for dependency in depends:
+            keys = self._dependents.get(dependency)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._dependents[dependency]
+
+    def invalidate_tables(self, path, tables):
+        # A write to ANY_TABLE drops every entry read from path.
+        with self._lock:
+            self._version += 1
+            if ANY_TABLE in tables:
+                self._written_at[path] = self._version
+                tables = [table for dependency_path, table in self._dependents
+                          if dependency_path == path]
+            targets = {(path, table) for table in tables}
+            targets.add((path, ANY_TABLE))
+            for dependency in targets:
+                self._written_at[dependency] = self._version
+                for key in list(self._dependents.get(dependency, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dependents.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale_hits": self.stale_hits,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+query_cache = QueryCache()
+
+@on_commit
+def invalidate_tables(path, tables):
+    for cache in list(caches):
+        cache.invalidate_tables(path, tables)
+
+def cache_query(func=None, *, cache=None, ttl=None):
+    # Under with_db_connection, lookups run before a connection is checked
+    # out, and only the caller that runs a miss takes one; hits and
+    # callers waiting on another's miss hold none. The inner functions get
+    # the database path and a connection() context manager, which yields
+    # the caller's conn when called directly.
+    if func is None:
+        return functools.partial(cache_query, cache=cache, ttl=ttl)
+    # Part of every key, so functions running the same SQL never share
+    # entries.
+    name = (func.__module__, func.__qualname__)
+
+    if inspect.isgeneratorfunction(func):
+        # Streams are not coalesced: each miss streams from the database,
+        # keeping a copy of the rows that is stored once the stream is
+        # drained, unless it outgrows the cache's byte budget first. A hit
+        # streams the cached rows.
+        def cached_stream(path, connection, /, query, *args, **kwargs):
+            store = query_cache if cache is None else cache
+            key = (name, path, query, freeze(args), freeze(kwargs))
+            found, rows = store.get(key)
+            if found:
+                yield from rows
+                return
+            kept, size = [], 0
+            with connection() as conn:
+                since = store.version()
+                if isinstance(conn, TrackedConnection):
+                    scope = conn.reads()
+                else:
+                    scope = contextlib.nullcontext(None)
+                with scope as tables:
+                    for row in func(conn, query, *args, **kwargs):
+                        if kept is not None:
+                            kept.append(row)
+                            size += estimate_size(row)
+                            if size > store.max_bytes:
+                                kept = None
+                        yield row
+            if kept is not None:
+                store.set(
+                    key, kept, ttl, path=path, tables=tables, since=since + 1
+                )
+
+        @functools.wraps(func)
+        def stream_wrapper(conn, query, *args, **kwargs):
+            yield from cached_stream(
+                database_path(conn), lambda: contextlib.nullcontext(conn),
+                query, *args, **kwargs
+            )
+        return defer_connection(read_only(stream_wrapper), cached_stream)
+
+    if inspect.iscoroutinefunction(func):
+        async def acached(path, connection, /, query, *args, **kwargs):
+            store = query_cache if cache is None else cache
+            key = (name, path, query, freeze(args), freeze(kwargs))
+
+            async def compute():
+                async with connection() as conn:
+                    # Connections from db.aconnect carry the
+                    # TrackedConnection underneath; others are cached
+                    # untracked.
+                    tracked = getattr(conn, "tracked", None)
+                    since = store.version()
+                    if tracked is not None:
+                        with tracked.reads() as tables:
+                            result = await func(conn, query, *args, **kwargs)
+                    else:
+                        tables = None
+                        result = await func(conn, query, *args, **kwargs)
+                store.set(
+                    key, result, ttl, path=path, tables=tables,
+                    since=since + 1
+                )
+                return result
+            return await store.afetch(key, compute)
+
+        @functools.wraps(func)
+        async def async_wrapper(conn, query, *args, **kwargs):
+            return await acached(
+                getattr(conn, "path", None),
+                lambda: contextlib.nullcontext(conn), query, *args, **kwargs
+            )
+        return defer_connection(read_only(async_wrapper), acached)
+
+    def cached(path, connection, /, query, *args, **kwargs):
+        store = query_cache if cache is None else cache
+        # Bound parameters and the database file are part of the key, so
+        # the same SQL against different values or files never collides.
+        key = (name, path, query, freeze(args), freeze(kwargs))
+
+        def compute():
+            with connection() as conn:
+                since = store.version()
+                if isinstance(conn, TrackedConnection):
+                    with conn.reads() as tables:
+                        result = func(conn, query, *args, **kwargs)
+                else:
+                    # Untracked connection: depend on every table.
+                    tables = None
+                    result = func(conn, query, *args, **kwargs)
+            store.set(
+                key, result, ttl, path=path, tables=tables, since=since + 1
+            )
             return result
-        finally:
-            conn.close()
-    return wrapper
+        return store.fetch(key, compute)
+
+    @functools.wraps(func)
+    def wrapper(conn, query, *args, **kwargs):
+        return cached(
+            database_path(conn), lambda: contextlib.nullcontext(conn),
+            query, *args, **kwargs
+        )
+    # Cached functions only read, so they can run on a replica.
+    return defer_connection(read_only(wrapper), cached)
 
 @with_db_connection
 @cache_query
@@ -33,8 +413,14 @@ def fetch_users_with_cache(conn, query):
     cursor.execute(query)
     return cursor.fetchall()
 
+@with_db_connection
+@cache_query
+def stream_users_with_cache(conn, query, chunk_size=1000):
+    yield from statements.stream(conn, query, chunk_size=chunk_size)
+
 if __name__ == "__main__":
     print("First run (executes query):")
     print(fetch_users_with_cache(query="SELECT * FROM users"))
     print("\nSecond run (uses cache):")
-    print(fetch_users_with_cache(query="SELECT * FROM users"))
\ No newline at end of file
+    print(fetch_users_with_cache(query="SELECT * FROM users"))
+    print("\nCache stats:", query_cache.stats())
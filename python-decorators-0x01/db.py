@@ -0,0 +1,826 @@
+import os
+import re
+import sqlite3
+import functools
+import inspect
+import itertools
+import threading
+import time
+import weakref
+from collections.abc import Iterator
+from contextlib import asynccontextmanager, contextmanager
+from urllib.request import pathname2url
+
+DATABASE = 'users.db'
+
+# sqlite3 keeps this many compiled statements per connection (default 128);
+# sized well above the registered statements so they stay compiled on
+# long-lived pooled connections.
+CACHED_STATEMENTS = 256
+
+# Applied once per connection, when the pool opens it.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,
+    "temp_store": "MEMORY",
+}
+
+# Read-only connections cannot change journal_mode or synchronous;
+# query_only makes an accidental write fail instead of reaching a replica.
+READ_ONLY_PRAGMAS = {
+    "query_only": "ON",
+    "cache_size": -16000,
+    "temp_store": "MEMORY",
+}
+
+# StatementRegistry.prepare() compiles statements with EXPLAIN; the tables
+# the authorizer reports for those are not really read or written.
+EXPLAIN = re.compile(r"\s*EXPLAIN\b", re.IGNORECASE)
+
+WRITE_ACTIONS = frozenset(
+    (sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE, sqlite3.SQLITE_DELETE)
+)
+
+# Stands in for "every table" when a statement could not be tracked.
+ANY_TABLE = "*"
+
+# Called as listener(path, tables) after a commit that wrote those tables.
+commit_listeners = []
+
+def on_commit(listener):
+    if listener not in commit_listeners:
+        commit_listeners.append(listener)
+    return listener
+
+class TrackedConnection(sqlite3.Connection):
+    # Records the tables each statement reads and writes through the
+    # authorizer, and tells the commit listeners which tables a commit
+    # wrote. Pass as sqlite3.connect(..., factory=TrackedConnection).
+    #
+    # The authorizer only runs when a statement is compiled, and sqlite3
+    # reuses compiled statements, so the tables are remembered per SQL text.
+    # A statement whose tables were forgotten but which sqlite3 still had
+    # compiled is counted as reading ANY_TABLE, and as writing ANY_TABLE
+    # if it changed any rows.
+    max_statements = 512
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tables_written = set()
+        self._statement_tables = {}
+        self._read_scopes = []
+        self._compiling = None
+        self._authorized = False
+        # Before Python 3.11, Connection.execute goes through cursor(), so
+        # the attributes above must exist before the first query.
+        self.path = super().execute("PRAGMA database_list").fetchone()[2]
+        self.set_authorizer(self._authorize)
+
+    def _authorize(self, action, table, column, database, trigger):
+        if self._compiling is not None:
+            if action != sqlite3.SQLITE_TRANSACTION:
+                # Not the BEGIN sqlite3 compiles before a DML statement.
+                self._authorized = True
+            if action == sqlite3.SQLITE_READ:
+                self._compiling[0].add(table)
+            elif action in WRITE_ACTIONS:
+                self._compiling[1].add(table)
+        return sqlite3.SQLITE_OK
+
+    @contextmanager
+    def tracking(self, sql=None):
+        # sql=None is for scripts, which are compiled afresh on every run.
+        tables = self._statement_tables.get(sql)
+        if tables is None and sql is not None and EXPLAIN.match(sql):
+            yield
+            return
+        compiling = (set(), set()) if tables is None else tables
+        changes = self.total_changes
+        self._compiling = compiling
+        self._authorized = False
+        try:
+            yield
+        finally:
+            self._compiling = None
+            if tables is not None or sql is None:
+                tables = compiling
+            elif self._authorized:
+                tables = compiling
+                if len(self._statement_tables) >= self.max_statements:
+                    # Oldest first; anything still compiled in sqlite3's
+                    # cache falls back to ANY_TABLE below.
+                    del self._statement_tables[
+                        next(iter(self._statement_tables))
+                    ]
+                self._statement_tables[sql] = tables
+            else:
+                tables = (
+                    {ANY_TABLE},
+                    {ANY_TABLE} if self.total_changes != changes else set()
+                )
+            reads, writes = tables
+            for scope in self._read_scopes:
+                scope.update(reads)
+            self.tables_written.update(writes)
+            if not self.in_transaction:
+                # Autocommit mode: the write is already durable.
+                self._written_committed()
+
+    @contextmanager
+    def reads(self):
+        scope = set()
+        self._read_scopes.append(scope)
+        try:
+            yield scope
+        finally:
+            self._read_scopes.remove(scope)
+
+    def _written_committed(self):
+        if self.tables_written:
+            written, self.tables_written = self.tables_written, set()
+            for listener in list(commit_listeners):
+                listener(self.path, written)
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TrackedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        super().commit()
+        self._written_committed()
+
+    def rollback(self):
+        super().rollback()
+        self.tables_written.clear()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        result = super().__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            self._written_committed()
+        else:
+            self.tables_written.clear()
+        return result
+
+class TrackedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        with self.connection.tracking(sql):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with self.connection.tracking(sql):
+            return super().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        with self.connection.tracking():
+            return super().executescript(sql_script)
+
+def database_path(conn):
+    path = getattr(conn, "path", None)
+    if path is None:
+        path = conn.execute("PRAGMA database_list").fetchone()[2]
+    return path
+
+async def _completed(value):
+    return value
+
+QUOTED = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+PARAMETERS = re.compile(r"\?(\d*)|[:@$]([A-Za-z_]\w*)")
+
+def blank_parameters(sql):
+    # A value for every parameter in sql, for compiling it with EXPLAIN:
+    # None per ? (numbered ?NNN count up to NNN), or a dict of None for
+    # named parameters.
+    count = 0
+    names = {}
+    for number, name in PARAMETERS.findall(QUOTED.sub("", sql)):
+        if name:
+            names[name] = None
+        else:
+            count = max(count, int(number)) if number else count + 1
+    return names or (None,) * count
+
+class Statement:
+    __slots__ = ("name", "sql", "blank_params", "calls", "errors",
+                 "total_time")
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.blank_params = blank_parameters(sql)
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+
+class StatementRegistry:
+    # Named SQL shared by the decorated functions. Each statement is
+    # compiled with EXPLAIN (which checks it against the schema without
+    # running it) on its first use against a database; one that fails is
+    # checked again on its next use, and never affects other statements.
+    # Executions go through the same SQL text, so each pooled connection's
+    # statement cache holds them compiled after their first run.
+    def __init__(self):
+        self._statements = {}
+        self._by_sql = {}
+        self._validated = set()
+        self._lock = threading.Lock()
+
+    def register(self, name, sql):
+        with self._lock:
+            statement = self._statements.get(name)
+            if statement is not None and statement.sql != sql:
+                raise ValueError(f"statement {name!r} is already registered")
+            if statement is None:
+                statement = self._statements[name] = Statement(name, sql)
+                self._by_sql[sql] = statement
+        return name
+
+    def resolve(self, name_or_sql):
+        # Raw SQL that matches a registered statement counts towards it;
+        # any other SQL runs untracked.
+        return (self._statements.get(name_or_sql)
+                or self._by_sql.get(name_or_sql))
+
+    def prepare(self, conn, statements=None):
+        # Checks statements (all registered ones by default) up front,
+        # raising ProgrammingError for the first that does not compile.
+        path = database_path(conn)
+        for statement in list(statements or self._statements.values()):
+            if (path, statement.name) in self._validated:
+                continue
+            try:
+                conn.execute(
+                    f"EXPLAIN {statement.sql}", statement.blank_params
+                ).fetchall()
+            except sqlite3.Error as e:
+                raise sqlite3.ProgrammingError(
+                    f"statement {statement.name!r} is invalid: {e}"
+                ) from e
+            self._validated.add((path, statement.name))
+
+    def _run(self, conn, name_or_sql, params, fetch):
+        statement = self.resolve(name_or_sql)
+        if statement is None:
+            return fetch(conn.execute(name_or_sql, params))
+        if (database_path(conn), statement.name) not in self._validated:
+            self.prepare(conn, (statement,))
+        started = time.perf_counter()
+        try:
+            return fetch(conn.execute(statement.sql, params))
+        except Exception:
+            statement.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                statement.calls += 1
+                statement.total_time += elapsed
+
+    async def aprepare(self, conn, statements=None):
+        path = database_path(conn)
+        for statement in list(statements or self._statements.values()):
+            if (path, statement.name) in self._validated:
+                continue
+            try:
+                cursor = await conn.execute(
+                    f"EXPLAIN {statement.sql}", statement.blank_params
+                )
+                await cursor.fetchall()
+            except sqlite3.Error as e:
+                raise sqlite3.ProgrammingError(
+                    f"statement {statement.name!r} is invalid: {e}"
+                ) from e
+            self._validated.add((path, statement.name))
+
+    async def _arun(self, conn, name_or_sql, params, fetch):
+        # _run() for aiosqlite connections; fetch returns an awaitable.
+        statement = self.resolve(name_or_sql)
+        if statement is None:
+            return await fetch(await conn.execute(name_or_sql, params))
+        if (database_path(conn), statement.name) not in self._validated:
+            await self.aprepare(conn, (statement,))
+        started = time.perf_counter()
+        try:
+            return await fetch(await conn.execute(statement.sql, params))
+        except Exception:
+            statement.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                statement.calls += 1
+                statement.total_time += elapsed
+
+    def stream(self, conn, name_or_sql, params=(), chunk_size=1000):
+        # Yields rows fetched chunk_size at a time. A registered statement
+        # is charged for the time spent executing and fetching, not for the
+        # time the consumer holds each chunk.
+        statement = self.resolve(name_or_sql)
+        sql = name_or_sql if statement is None else statement.sql
+        if statement is not None and (
+            (database_path(conn), statement.name) not in self._validated
+        ):
+            self.prepare(conn, (statement,))
+        elapsed = 0.0
+        failed = False
+        started = time.perf_counter()
+        try:
+            cursor = conn.execute(sql, params)
+            try:
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    elapsed += time.perf_counter() - started
+                    if not rows:
+                        break
+                    yield from rows
+                    started = time.perf_counter()
+            finally:
+                cursor.close()
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if statement is not None:
+                with self._lock:
+                    statement.calls += 1
+                    statement.errors += failed
+                    statement.total_time += elapsed
+
+    def execute(self, conn, name_or_sql, params=()):
+        return self._run(conn, name_or_sql, params, lambda cursor: cursor)
+
+    def fetchone(self, conn, name_or_sql, params=()):
+        return self._run(
+            conn, name_or_sql, params, lambda cursor: cursor.fetchone()
+        )
+
+    def fetchall(self, conn, name_or_sql, params=()):
+        return self._run(
+            conn, name_or_sql, params, lambda cursor: cursor.fetchall()
+        )
+
+    async def aexecute(self, conn, name_or_sql, params=()):
+        return await self._arun(conn, name_or_sql, params, _completed)
+
+    async def afetchone(self, conn, name_or_sql, params=()):
+        return await self._arun(
+            conn, name_or_sql, params, lambda cursor: cursor.fetchone()
+        )
+
+    async def afetchall(self, conn, name_or_sql, params=()):
+        return await self._arun(
+            conn, name_or_sql, params, lambda cursor: cursor.fetchall()
+        )
+
+    def stats(self):
+        with self._lock:
+            return {
+                statement.name: {
+                    "sql": statement.sql,
+                    "calls": statement.calls,
+                    "errors": statement.errors,
+                    "total_ms": statement.total_time * 1000,
+                    "mean_ms": (
+                        statement.total_time / statement.calls * 1000
+                        if statement.calls else 0.0
+                    ),
+                }
+                for statement in self._statements.values()
+            }
+
+statements = StatementRegistry()
+
+def read_only_uri(database):
+    return f"file:{pathname2url(os.path.abspath(database))}?mode=ro"
+
+def connect(database=DATABASE, pragmas=None,
+            cached_statements=CACHED_STATEMENTS, read_only=False):
+    # check_same_thread is off because a pooled connection can be checked
+    # out by a different thread each time; the pool never shares one
+    # between two threads at once.
+    if pragmas is None:
+        pragmas = READ_ONLY_PRAGMAS if read_only else PRAGMAS
+    conn = sqlite3.connect(
+        read_only_uri(database) if read_only else database,
+        factory=TrackedConnection, check_same_thread=False,
+        cached_statements=cached_statements, uri=read_only
+    )
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+_NO_ROW = object()
+
+class Stream:
+    # Iterator over rows produced while something is held open. on_close
+    # runs once, when the rows run out or fail, or the stream is closed or
+    # garbage-collected.
+    def __init__(self, rows, on_close=None, first=_NO_ROW):
+        self._rows = rows
+        self._on_close = on_close
+        self._first = first
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._first is not _NO_ROW:
+            first, self._first = self._first, _NO_ROW
+            return first
+        if self._rows is None:
+            raise StopIteration
+        try:
+            return next(self._rows)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        rows, self._rows = self._rows, None
+        if rows is None:
+            return
+        try:
+            close = getattr(rows, "close", None)
+            if close is not None:
+                close()
+        finally:
+            if self._on_close is not None:
+                self._on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+def prime(rows):
+    # Pulls the first row now, so an error from running the query is
+    # raised by the call that started it rather than on first iteration.
+    try:
+        first = next(rows)
+    except StopIteration:
+        return Stream(iter(()))
+    except BaseException:
+        close = getattr(rows, "close", None)
+        if close is not None:
+            close()
+        raise
+    return Stream(rows, first=first)
+
+async def aconnect(database=DATABASE, pragmas=None,
+                   cached_statements=CACHED_STATEMENTS, read_only=False,
+                   path=None):
+    # aiosqlite runs the connection on its own worker thread. The
+    # TrackedConnection underneath is kept as `tracked`, so table tracking
+    # and commit listeners work the same as for sync connections.
+    import aiosqlite
+    opened = []
+
+    def factory(*args, **kwargs):
+        conn = TrackedConnection(*args, **kwargs)
+        opened.append(conn)
+        return conn
+
+    if pragmas is None:
+        pragmas = READ_ONLY_PRAGMAS if read_only else PRAGMAS
+    conn = await aiosqlite.connect(
+        read_only_uri(database) if read_only else database,
+        factory=factory, cached_statements=cached_statements, uri=read_only
+    )
+    conn.tracked = opened[0]
+    if path is not None:
+        conn.tracked.path = path
+    conn.path = conn.tracked.path
+    try:
+        for name, value in pragmas.items():
+            await conn.execute(f"PRAGMA {name} = {value}")
+    except BaseException:
+        await conn.close()
+        raise
+    return conn
+
+class PoolExhausted(RuntimeError):
+    pass
+
+class ConnectionPool:
+    # mode="checkout": up to `size` connections shared by all threads, each
+    # held by one caller at a time. mode="thread": one connection per
+    # thread, kept until the pool is closed; `size` is not enforced.
+    #
+    # read_only pools open `mode=ro` connections. `path` overrides the
+    # path their connections report, so a replica copy can stand for the
+    # primary in cache keys and invalidation.
+    def __init__(self, database=DATABASE, size=8, mode="checkout",
+                 timeout=30.0, pragmas=None, read_only=False, path=None):
+        if mode not in ("checkout", "thread"):
+            raise ValueError("mode must be 'checkout' or 'thread'")
+        self.database = database
+        self.size = size
+        self.mode = mode
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.read_only = read_only
+        self.path = path
+        self.busy = 0
+        self._idle = []
+        self._open = []
+        self._connecting = 0
+        self._local = threading.local()
+        # mode="thread": nested acquires per connection, kept here rather
+        # than in _local so a stream can be released from any thread.
+        self._depth = {}
+        self._condition = threading.Condition()
+        self.checkouts = 0
+        self.reused = 0
+        self.waits = 0
+        self.checkout_time = 0.0
+        self.max_checkout_time = 0.0
+
+    def _connect(self):
+        try:
+            conn = connect(
+                self.database, self.pragmas, read_only=self.read_only
+            )
+            if self.path is not None:
+                conn.path = self.path
+        except BaseException:
+            with self._condition:
+                self._connecting -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._connecting -= 1
+            self._open.append(conn)
+        return conn
+
+    def acquire(self):
+        started = time.perf_counter()
+        if self.mode == "thread":
+            conn = getattr(self._local, "conn", None)
+            reused = conn is not None
+            if not reused:
+                with self._condition:
+                    self._connecting += 1
+                conn = self._local.conn = self._connect()
+            # Nested calls on one thread share the connection; only the
+            # outermost release ends its transaction.
+            with self._condition:
+                self._depth[conn] = self._depth.get(conn, 0) + 1
+        else:
+            conn, reused = self._checkout(started)
+        elapsed = time.perf_counter() - started
+        with self._condition:
+            self.busy += 1
+            self.checkouts += 1
+            self.reused += reused
+            self.checkout_time += elapsed
+            self.max_checkout_time = max(self.max_checkout_time, elapsed)
+        return conn
+
+    def _checkout(self, started):
+        with self._condition:
+            waited = False
+            while (not self._idle
+                   and len(self._open) + self._connecting >= self.size):
+                waited = True
+                remaining = self.timeout - (time.perf_counter() - started)
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    raise PoolExhausted(
+                        f"No connection available within {self.timeout}s"
+                    )
+            self.waits += waited
+            if self._idle:
+                return self._idle.pop(), True
+            # Reserve the slot, then connect outside the lock.
+            self._connecting += 1
+        return self._connect(), False
+
+    def release(self, conn):
+        with self._condition:
+            self.busy -= 1
+            if self.mode == "thread":
+                depth = self._depth.pop(conn, 1) - 1
+                if depth:
+                    self._depth[conn] = depth
+                    return
+        # Work the caller left uncommitted is dropped, as closing the
+        # connection used to do.
+        if conn.in_transaction:
+            conn.rollback()
+        if self.mode == "checkout":
+            with self._condition:
+                self._idle.append(conn)
+                self._condition.notify()
+
+    def database_path(self):
+        # The path this pool's connections report; found by opening one
+        # the first time, then kept as `path`.
+        if self.path is None:
+            with self.connection() as conn:
+                self.path = conn.path
+        return self.path
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self._condition:
+            conns, self._open, self._idle = self._open, [], []
+            self._depth = {}
+        self._local = threading.local()
+        for conn in conns:
+            conn.close()
+
+    def metrics(self):
+        with self._condition:
+            return {
+                "mode": self.mode,
+                "open": len(self._open),
+                "idle": len(self._idle),
+                "busy": self.busy,
+                "checkouts": self.checkouts,
+                "reused": self.reused,
+                "waits": self.waits,
+                "reuse_rate": (
+                    self.reused / self.checkouts if self.checkouts else 0.0
+                ),
+                "mean_checkout_ms": (
+                    self.checkout_time / self.checkouts * 1000
+                    if self.checkouts else 0.0
+                ),
+                "max_checkout_ms": self.max_checkout_time * 1000,
+            }
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def configure_pool(**kwargs):
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+        _pool = ConnectionPool(**kwargs)
+        _pool_pid = os.getpid()
+        return _pool
+
+def get_pool():
+    # Keyed on the pid so a forked process never reuses its parent's
+    # connections.
+    if _pool is None or _pool_pid != os.getpid():
+        return configure_pool()
+    return _pool
+
+def pool_metrics():
+    return get_pool().metrics()
+
+_replicas = []
+_replicas_pid = None
+_replica_policy = "round_robin"
+_replica_turn = itertools.count()
+
+def configure_replicas(databases=None, policy="round_robin", **kwargs):
+    # Read-only calls go to one pool per replica database, picked
+    # round-robin or by fewest connections in use ("least_busy"). With no
+    # databases, the primary file itself is opened read-only, which adds
+    # readers without a copy to keep in sync. Pass () to route everything
+    # to the primary again.
+    #
+    # Replica connections report the primary's path, so cached reads are
+    # keyed and invalidated as if they ran on the primary; a copy that
+    # lags can still be cached after a write's invalidation.
+    global _replicas, _replicas_pid, _replica_policy
+    if policy not in ("round_robin", "least_busy"):
+        raise ValueError("policy must be 'round_robin' or 'least_busy'")
+    databases = None if databases is None else list(databases)
+    # The path primary connections report, which resolves symlinks.
+    primary = get_pool().database_path() if databases != [] else None
+    with _pool_lock:
+        if _replicas_pid == os.getpid():
+            for pool in _replicas:
+                pool.close()
+        _replicas = [
+            ConnectionPool(database, read_only=True, path=primary, **kwargs)
+            for database in ((primary,) if databases is None else databases)
+        ]
+        _replicas_pid = os.getpid()
+        _replica_policy = policy
+        return _replicas
+
+def get_read_pool():
+    if not _replicas:
+        return get_pool()
+    if _replicas_pid != os.getpid():
+        configure_replicas(
+            [pool.database for pool in _replicas], _replica_policy
+        )
+    turn = next(_replica_turn) % len(_replicas)
+    if _replica_policy == "least_busy":
+        # Scans from the round-robin position so ties still rotate.
+        return min(
+            _replicas[turn:] + _replicas[:turn], key=lambda pool: pool.busy
+        )
+    return _replicas[turn]
+
+def replica_metrics():
+    return [dict(pool.metrics(), database=pool.database) for pool in _replicas]
+
+def read_only(func):
+    # Marks func as safe to run on a replica. with_db_connection still
+    # sends it to the primary if it is also transactional.
+    func.__read_only__ = True
+    return func
+
+def is_read_only(func):
+    return (getattr(func, "__read_only__", False)
+            and not getattr(func, "__transactional__", False))
+
+# Handlers for decorated functions that can often answer without a
+# connection (see cache_query); keyed by the function itself, so a wrapper
+# that copies its attributes does not inherit the handler.
+_deferred = weakref.WeakKeyDictionary()
+
+def defer_connection(func, handler):
+    # with_db_connection(func) calls handler(path, connection, *args,
+    # **kwargs) instead of func, where path is the database path and
+    # connection() is a context manager (an async one for coroutine
+    # functions) that checks out a connection only when entered.
+    _deferred[func] = handler
+    return func
+
+@asynccontextmanager
+async def _aconnection(pool):
+    # Counted in pool.busy while open, so least_busy sees async callers.
+    with pool._condition:
+        pool.busy += 1
+    try:
+        conn = await aconnect(
+            pool.database, read_only=pool.read_only, path=pool.path
+        )
+        try:
+            yield conn
+        finally:
+            await conn.close()
+    finally:
+        with pool._condition:
+            pool.busy -= 1
+
+def with_db_connection(func):
+    # Read-only functions (see read_only()) get a replica connection when
+    # replicas are configured; everything else gets the primary.
+    reads = is_read_only(func)
+    deferred = _deferred.get(func)
+
+    if inspect.iscoroutinefunction(func):
+        # Each call gets its own aiosqlite connection, closed (and any
+        # uncommitted work dropped) when it returns. They are not pooled:
+        # each owns a non-daemon worker thread that must not outlive the
+        # event loop it was opened on.
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            pool = get_read_pool() if reads else get_pool()
+            if deferred is not None:
+                return await deferred(
+                    pool.database_path(), lambda: _aconnection(pool),
+                    *args, **kwargs
+                )
+            async with _aconnection(pool) as conn:
+                return await func(conn, *args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        pool = get_read_pool() if reads else get_pool()
+        if deferred is not None:
+            return deferred(
+                pool.database_path(), pool.connection, *args, **kwargs
+            )
+        conn = pool.acquire()
+        try:
+            result = func(conn, *args, **kwargs)
+        except BaseException:
+            pool.release(conn)
+            raise
+        if isinstance(result, Iterator):
+            # Streaming result (a generator, cursor or Stream): the
+            # connection stays checked out until it is exhausted or closed.
+            return Stream(result, lambda: pool.release(conn))
+        pool.release(conn)
+        return result
+    return wrapper
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""Tests for cache_query: invalidation on commit and single flight."""
+import asyncio
+import importlib
+import threading
+import time
+import unittest
+
+import db
+from test_db import DatabaseTestCase
+
+cache_module = importlib.import_module("4-cache_query")
+transactional = importlib.import_module("2-transactional").transactional
+
+
+@db.with_db_connection
+@cache_module.cache_query
+def email_of(conn, query, user_id):
+    return conn.execute(query, (user_id,)).fetchone()[0]
+
+
+@db.with_db_connection
+@transactional
+def set_email(conn, user_id, email):
+    conn.execute(
+        "UPDATE users SET email = ? WHERE id = ?", (email, user_id)
+    )
+
+
+calls = []
+
+
+@db.with_db_connection
+@cache_module.cache_query
+def slow_email_of(conn, query, user_id):
+    calls.append(user_id)
+    time.sleep(0.1)
+    return conn.execute(query, (user_id,)).fetchone()[0]
+
+
+@db.with_db_connection
+@cache_module.cache_query
+async def async_email_of(conn, query, user_id):
+    async with conn.execute(query, (user_id,)) as cursor:
+        return (await cursor.fetchone())[0]
+
+
+EMAIL = "SELECT email FROM users WHERE id = ?"
+
+
+class CacheTestCase(DatabaseTestCase):
+    """Empty shared cache over a fresh users table."""
+
+    def setUp(self):
+        super().setUp()
+        self.create_users()
+        cache_module.query_cache.clear()
+
+
+class TestInvalidation(CacheTestCase):
+    """Committed writes drop the cached reads of the tables they wrote."""
+
+    def test_commit_invalidates(self):
+        """A read after a committed write sees the new value."""
+        self.assertEqual(email_of(EMAIL, 1), "alice@example.com")
+        set_email(1, "alice@new.example.com")
+        self.assertEqual(email_of(EMAIL, 1), "alice@new.example.com")
+
+    def test_rollback_keeps_entries(self):
+        """A rolled-back write invalidates nothing."""
+        email_of(EMAIL, 1)
+        with self.pool.connection() as conn:
+            conn.execute("UPDATE users SET email = 'x' WHERE id = 1")
+            conn.rollback()
+        self.assertEqual(len(cache_module.query_cache), 1)
+
+    def test_other_table_keeps_entries(self):
+        """A write to an unrelated table leaves users entries cached."""
+        email_of(EMAIL, 1)
+        with self.pool.connection() as conn:
+            conn.execute("CREATE TABLE audit (note TEXT)")
+            conn.execute("INSERT INTO audit VALUES ('x')")
+            conn.commit()
+        self.assertEqual(len(cache_module.query_cache), 1)
+
+    def test_write_during_read_is_not_cached(self):
+        """A result read before a racing commit is not stored."""
+        cache = cache_module.QueryCache()
+        since = cache.version()
+        cache.invalidate_tables(self.database, {"users"})
+        cache.set("key", "old", path=self.database, tables={"users"},
+                  since=since + 1)
+        self.assertEqual(cache.get("key"), (False, None))
+
+    def test_forgotten_statements_still_invalidate(self):
+        """Statements dropped from the table memo but still compiled in
+        sqlite3's statement cache fall back to every table."""
+        update = "UPDATE users SET email = ? WHERE id = ?"
+        with self.pool.connection() as conn:
+            for index in range(db.TrackedConnection.max_statements):
+                if index % 64 == 0:
+                    # Keeps both hot in sqlite3's cache, but not the memo.
+                    conn.execute(EMAIL, (1,))
+                    conn.execute(update, ("bob@example.com", 2))
+                    conn.commit()
+                conn.execute(f"SELECT {index}")
+            self.assertNotIn(EMAIL, conn._statement_tables)
+            self.assertNotIn(update, conn._statement_tables)
+        self.assertEqual(email_of(EMAIL, 1), "alice@example.com")
+        set_email(1, "alice@new.example.com")
+        self.assertEqual(email_of(EMAIL, 1), "alice@new.example.com")
+
+    def test_validation_keeps_entries(self):
+        """Compiling a write with EXPLAIN invalidates nothing."""
+        registry = db.StatementRegistry()
+        registry.register("users.rename",
+                          "UPDATE users SET name = ? WHERE id = ?")
+        email_of(EMAIL, 1)
+        invalidations = cache_module.query_cache.invalidations
+        with self.pool.connection() as conn:
+            registry.prepare(conn)
+
+        async def aprepare():
+            conn = await db.aconnect(self.database)
+            try:
+                await registry.aprepare(conn)
+            finally:
+                await conn.close()
+        registry._validated.clear()
+        asyncio.run(aprepare())
+        self.assertEqual(len(cache_module.query_cache), 1)
+        self.assertEqual(cache_module.query_cache.invalidations,
+                         invalidations)
+
+
+class TestKeys(CacheTestCase):
+    """Entries are keyed by function, database, SQL and parameters."""
+
+    def test_functions_do_not_share_entries(self):
+        """Two cached functions running the same SQL keep separate entries."""
+        query = "SELECT name FROM users ORDER BY id"
+        rows = cache_module.fetch_users_with_cache(query=query)
+        streamed = list(cache_module.stream_users_with_cache(query=query))
+        self.assertEqual(rows, streamed)
+        self.assertEqual(len(cache_module.query_cache), 2)
+
+    def test_parameters_are_part_of_the_key(self):
+        """The same SQL with other parameters is a separate entry."""
+        self.assertEqual(email_of(EMAIL, 1), "alice@example.com")
+        self.assertEqual(email_of(EMAIL, 2), "bob@example.com")
+
+
+class TestSingleFlight(CacheTestCase):
+    """Concurrent misses on one key run the query once."""
+
+    pool_options = {"size": 4}
+
+    def setUp(self):
+        super().setUp()
+        calls.clear()
+
+    def run_concurrently(self, count):
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(slow_email_of(EMAIL, 1))
+            )
+            for _ in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesced_misses(self):
+        """Followers share the leader's result and hold no connection."""
+        self.pool.database_path()
+        results = self.run_concurrently(20)
+        self.assertEqual(results, ["alice@example.com"] * 20)
+        self.assertEqual(calls, [1])
+        metrics = self.pool.metrics()
+        self.assertEqual(metrics["waits"], 0)
+        self.assertEqual(metrics["open"], 1)
+
+    def test_hits_take_no_connection(self):
+        """A cache hit does not check out a connection."""
+        email_of(EMAIL, 1)
+        checkouts = self.pool.metrics()["checkouts"]
+        email_of(EMAIL, 1)
+        self.assertEqual(self.pool.metrics()["checkouts"], checkouts)
+
+    def test_stale_while_revalidate(self):
+        """Callers get the expired entry while one caller refreshes it."""
+        cache = cache_module.QueryCache(ttl=0.0, stale_ttl=60.0)
+        cache.set("key", "old")
+        started = threading.Event()
+
+        def refresh():
+            started.set()
+            time.sleep(0.1)
+            return "new"
+        thread = threading.Thread(target=cache.fetch, args=("key", refresh))
+        thread.start()
+        started.wait()
+        self.assertEqual(cache.fetch("key", lambda: "unused"), "old")
+        thread.join()
+        self.assertEqual(cache.stats()["stale_hits"], 1)
+
+    def test_async(self):
+        """Coroutine functions are cached and invalidated the same way."""
+        async def read_twice():
+            return [await async_email_of(EMAIL, 1) for _ in range(2)]
+        self.assertEqual(asyncio.run(read_twice()),
+                         ["alice@example.com"] * 2)
+        self.assertEqual(cache_module.query_cache.stats()["hits"], 1)
+        set_email(1, "alice@new.example.com")
+        self.assertEqual(asyncio.run(async_email_of(EMAIL, 1)),
+                         "alice@new.example.com")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Tests for the db module: statements, pool and replica routing."""
+import asyncio
+import importlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import db
+
+with_connection = importlib.import_module("1-with_db_connection")
+retry = importlib.import_module("3-retry_on_failure")
+cache_module = importlib.import_module("4-cache_query")
+update_user_email = importlib.import_module(
+    "2-transactional"
+).update_user_email
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Points the shared pool at an empty database in a temp directory."""
+
+    pool_options = {}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.tmp.name, "users.db")
+        self.pool = db.configure_pool(
+            database=self.database, **self.pool_options
+        )
+        db.configure_replicas(())
+
+    def tearDown(self):
+        db.configure_replicas(())
+        db.get_pool().close()
+        self.tmp.cleanup()
+
+    def create_users(self):
+        conn = sqlite3.connect(self.database)
+        conn.execute(
+            "CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT, "
+            "email TEXT)"
+        )
+        conn.executemany(
+            "INSERT INTO users (name, email) VALUES (?, ?)",
+            [("Alice", "alice@example.com"), ("Bob", "bob@example.com")],
+        )
+        conn.commit()
+        conn.close()
+
+
+class TestStatements(DatabaseTestCase):
+    """Statements are validated on their own first use."""
+
+    def test_invalid_statement_does_not_block_connections(self):
+        """A statement that cannot compile yet breaks no other call."""
+        @db.with_db_connection
+        def create(conn):
+            conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, "
+                         "name TEXT, email TEXT)")
+            conn.execute("INSERT INTO users (name) VALUES ('Alice')")
+            conn.commit()
+
+        create()
+        self.assertEqual(
+            with_connection.get_user_by_id(user_id=1)[1], "Alice"
+        )
+
+    def test_invalid_statement_fails_on_use(self):
+        """Using a statement that does not compile raises ProgrammingError."""
+        with self.pool.connection() as conn:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                db.statements.fetchone(conn, "users.by_id", (1,))
+
+    def test_named_parameters(self):
+        """Statements with :named parameters validate and run."""
+        self.create_users()
+        db.statements.register(
+            "users.by_name", "SELECT id FROM users WHERE name = :name"
+        )
+        with self.pool.connection() as conn:
+            row = db.statements.fetchone(
+                conn, "users.by_name", {"name": "Bob"}
+            )
+        self.assertEqual(row, (2,))
+
+    def test_blank_parameters(self):
+        """Every parameter style gets a placeholder value."""
+        self.assertEqual(db.blank_parameters("SELECT ?, '?', ?"),
+                         (None, None))
+        self.assertEqual(db.blank_parameters("SELECT ?3, ?"),
+                         (None,) * 4)
+        self.assertEqual(db.blank_parameters("SELECT :a, @b, $c"),
+                         {"a": None, "b": None, "c": None})
+
+
+class TestCheckoutPool(DatabaseTestCase):
+    """mode="checkout" shares up to `size` connections."""
+
+    pool_options = {"size": 2, "timeout": 0.05}
+
+    def test_reuses_released_connections(self):
+        """A released connection is handed to the next caller."""
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            self.assertIs(first, second)
+        metrics = self.pool.metrics()
+        self.assertEqual((metrics["open"], metrics["reused"]), (1, 1))
+
+    def test_exhausted(self):
+        """Waiting past the timeout for a connection raises."""
+        held = [self.pool.acquire(), self.pool.acquire()]
+        with self.assertRaises(db.PoolExhausted):
+            self.pool.acquire()
+        for conn in held:
+            self.pool.release(conn)
+        self.assertEqual(self.pool.metrics()["busy"], 0)
+
+    def test_release_rolls_back(self):
+        """Work left uncommitted is dropped on release."""
+        self.create_users()
+        with self.pool.connection() as conn:
+            conn.execute("DELETE FROM users")
+        with self.pool.connection() as conn:
+            count = conn.execute("SELECT count(*) FROM users").fetchone()
+        self.assertEqual(count, (2,))
+
+
+class TestThreadPool(DatabaseTestCase):
+    """mode="thread" keeps one connection per thread."""
+
+    pool_options = {"mode": "thread"}
+
+    def test_one_connection_per_thread(self):
+        """Nested acquires share a connection; other threads get theirs."""
+        outer = self.pool.acquire()
+        inner = self.pool.acquire()
+        self.assertIs(outer, inner)
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(self.pool.acquire())
+        )
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], outer)
+        self.pool.release(other[0])
+        self.pool.release(inner)
+        self.pool.release(outer)
+        self.assertEqual(self.pool.metrics()["busy"], 0)
+
+    def test_stream_closed_on_another_thread(self):
+        """A stream can release its connection from any thread."""
+        self.create_users()
+        stream = retry.stream_users_with_retry()
+        self.assertEqual(next(stream)[1], "Alice")
+        errors = []
+
+        def close():
+            try:
+                stream.close()
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=close)
+        thread.start()
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.pool.metrics()["busy"], 0)
+        self.assertEqual(self.pool._depth, {})
+
+
+class TestReplicas(DatabaseTestCase):
+    """Read-only functions go to replicas, everything else to the primary."""
+
+    def setUp(self):
+        super().setUp()
+        self.create_users()
+        cache_module.query_cache.clear()
+
+    def test_reads_use_replicas(self):
+        """Reads check out replica connections, which reject writes."""
+        replica, = db.configure_replicas()
+        self.assertEqual(with_connection.get_user_by_id(user_id=1)[1],
+                         "Alice")
+        self.assertEqual(replica.metrics()["checkouts"], 1)
+        with replica.connection() as conn:
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute("DELETE FROM users")
+
+    def test_writes_invalidate_replica_reads(self):
+        """Primary commits drop reads cached from a replica, even when the
+        database path goes through a symlink."""
+        link = os.path.join(self.tmp.name, "link")
+        os.symlink(self.tmp.name, link)
+        db.configure_pool(database=os.path.join(link, "users.db"))
+        db.configure_replicas()
+        query = "SELECT email FROM users WHERE id = 1"
+        self.assertEqual(cache_module.fetch_users_with_cache(query=query),
+                         [("alice@example.com",)])
+        update_user_email(user_id=1, new_email="alice@new.example.com")
+        self.assertEqual(cache_module.fetch_users_with_cache(query=query),
+                         [("alice@new.example.com",)])
+
+    def test_policies(self):
+        """round_robin alternates; least_busy skips a busy replica."""
+        copy = os.path.join(self.tmp.name, "copy.db")
+        shutil.copy(self.database, copy)
+        first, second = db.configure_replicas([self.database, copy])
+        self.assertEqual({db.get_read_pool(), db.get_read_pool()},
+                         {first, second})
+        db.configure_replicas([self.database, copy], policy="least_busy")
+        first, second = db._replicas
+        with first.connection():
+            self.assertEqual(
+                {db.get_read_pool() for _ in range(4)}, {second}
+            )
+
+    def test_async_reads_use_replicas(self):
+        """Coroutine functions are routed the same way."""
+        replica, = db.configure_replicas(policy="least_busy")
+
+        @db.with_db_connection
+        @db.read_only
+        async def path_of(conn):
+            self.assertEqual(replica.metrics()["busy"], 1)
+            return conn.path
+        self.assertEqual(asyncio.run(path_of()), replica.path)
+        self.assertEqual(replica.metrics()["busy"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Tests for log_queries tracing."""
+import importlib
+import unittest
+
+log_module = importlib.import_module("0-log_queries")
+
+
+class TestLogQueries(unittest.TestCase):
+    """Each sampled call leaves one record in the ring."""
+
+    def setUp(self):
+        self.trace = log_module.QueryTrace()
+
+    def test_list_result(self):
+        """Row counts come from list results."""
+        @log_module.log_queries(trace=self.trace)
+        def fetch(query, params=()):
+            return [(1,), (2,)]
+
+        fetch("SELECT id FROM users WHERE id IN (1, 2)", (1, 2))
+        record, = self.trace.recent()
+        self.assertEqual(record.fingerprint,
+                         "SELECT id FROM users WHERE id IN (?)")
+        self.assertEqual((record.params, record.rows, record.error),
+                         (2, 2, None))
+
+    def test_other_result(self):
+        """Results without a length record no row count."""
+        @log_module.log_queries(trace=self.trace)
+        def count(query):
+            return 3
+
+        count(query="SELECT count(*) FROM users")
+        self.assertIsNone(self.trace.recent()[0].rows)
+
+    def test_stream_result(self):
+        """Streams are recorded once drained, with the rows handed out."""
+        @log_module.log_queries(trace=self.trace)
+        def stream(query):
+            yield from range(3)
+
+        rows = stream("SELECT id FROM users")
+        self.assertEqual(self.trace.recent(), [])
+        self.assertEqual(list(rows), [0, 1, 2])
+        self.assertEqual(self.trace.recent()[0].rows, 3)
+
+    def test_error(self):
+        """Failures are recorded with the error and re-raised."""
+        @log_module.log_queries(trace=self.trace)
+        def fail(query):
+            raise ValueError("bad")
+
+        with self.assertRaises(ValueError):
+            fail("SELECT 1")
+        self.assertEqual(self.trace.recent()[0].error, "ValueError: bad")
+
+
+if __name__ == "__main__":
+    unittest.main()
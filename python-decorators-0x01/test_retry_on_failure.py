@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Tests for retry_on_failure: classification, backoff and the budget."""
+import asyncio
+import importlib
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest.mock import AsyncMock, patch
+
+retry = importlib.import_module("3-retry_on_failure")
+
+LOCKED = sqlite3.OperationalError("database is locked")
+SYNTAX = sqlite3.OperationalError('near "SELEC": syntax error')
+
+
+def failing(error, calls, succeed_after=None):
+    # A function that raises error on every call, or only on the first
+    # succeed_after calls.
+    def func():
+        calls.append(1)
+        if succeed_after is None or len(calls) <= succeed_after:
+            raise error
+        return "ok"
+    return func
+
+
+class TestIsRetryable(unittest.TestCase):
+    """Only lock contention is worth retrying."""
+
+    def test_messages(self):
+        """Lock messages retry; other errors do not."""
+        self.assertTrue(retry.is_retryable(LOCKED))
+        self.assertTrue(retry.is_retryable(
+            sqlite3.OperationalError("database table is locked")
+        ))
+        self.assertFalse(retry.is_retryable(SYNTAX))
+        self.assertFalse(retry.is_retryable(
+            sqlite3.IntegrityError("UNIQUE constraint failed: users.id")
+        ))
+
+    def test_real_lock(self):
+        """A write blocked by another connection's lock is retryable."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "locked.db")
+            holder = sqlite3.connect(path, isolation_level=None)
+            holder.execute("CREATE TABLE t (x)")
+            holder.execute("BEGIN IMMEDIATE")
+            blocked = sqlite3.connect(path, timeout=0)
+            try:
+                with self.assertRaises(sqlite3.OperationalError) as context:
+                    blocked.execute("INSERT INTO t VALUES (1)")
+                self.assertTrue(retry.is_retryable(context.exception))
+            finally:
+                blocked.close()
+                holder.close()
+
+
+class TestBackoff(unittest.TestCase):
+    """Delays are jittered below an exponential cap."""
+
+    def test_cap(self):
+        """Each delay stays within base * 2 ** attempt and max_delay."""
+        for attempt in range(8):
+            for _ in range(50):
+                delay = retry.backoff(attempt, 0.1, 2.0)
+                self.assertGreaterEqual(delay, 0)
+                self.assertLessEqual(delay, min(2.0, 0.1 * 2 ** attempt))
+
+
+class TestRetryOnFailure(unittest.TestCase):
+    """Retries follow the error class, the attempt limit and the budget."""
+
+    def setUp(self):
+        self.budget = retry.RetryBudget()
+        self.calls = []
+
+    def decorate(self, func, retries=3, budget=None):
+        return retry.retry_on_failure(
+            retries=retries, delay=0, budget=budget or self.budget
+        )(func)
+
+    def test_permanent_error_tried_once(self):
+        """A syntax error is raised on the first attempt."""
+        func = self.decorate(failing(SYNTAX, self.calls))
+        with self.assertRaises(sqlite3.OperationalError):
+            func()
+        self.assertEqual(len(self.calls), 1)
+
+    def test_locked_retried_up_to_retries(self):
+        """A lock error is attempted `retries` times in total."""
+        func = self.decorate(failing(LOCKED, self.calls), retries=4)
+        with self.assertRaises(sqlite3.OperationalError):
+            func()
+        self.assertEqual(len(self.calls), 4)
+
+    def test_recovers(self):
+        """A call that succeeds on a later attempt returns its result."""
+        func = self.decorate(failing(LOCKED, self.calls, succeed_after=2))
+        self.assertEqual(func(), "ok")
+        self.assertEqual(len(self.calls), 3)
+
+    def test_empty_budget_stops_retries(self):
+        """With no tokens left, a retryable error is raised at once."""
+        budget = retry.RetryBudget(max_tokens=0)
+        func = self.decorate(failing(LOCKED, self.calls), budget=budget)
+        with self.assertRaises(sqlite3.OperationalError):
+            func()
+        self.assertEqual(len(self.calls), 1)
+
+    def test_circuit_opens_and_half_opens(self):
+        """After `threshold` give-ups calls fail fast until `cooldown`
+        passes, then one trial call is let through."""
+        budget = retry.RetryBudget(threshold=2, cooldown=0.05)
+        func = self.decorate(
+            failing(LOCKED, self.calls), retries=1, budget=budget
+        )
+        for _ in range(2):
+            with self.assertRaises(sqlite3.OperationalError):
+                func()
+        with self.assertRaises(retry.CircuitOpen):
+            func()
+        self.assertEqual(len(self.calls), 2)
+        time.sleep(0.06)
+        self.assertTrue(budget.allow_call())
+        self.assertFalse(budget.allow_call())
+        budget.succeeded(retried=False)
+        self.assertTrue(budget.allow_call())
+
+    def test_trial_call_after_cooldown(self):
+        """The call after the cooldown runs and closes the circuit."""
+        budget = retry.RetryBudget(threshold=1, cooldown=0.05)
+        func = self.decorate(
+            failing(LOCKED, self.calls, succeed_after=1), retries=1,
+            budget=budget
+        )
+        with self.assertRaises(sqlite3.OperationalError):
+            func()
+        with self.assertRaises(retry.CircuitOpen):
+            func()
+        time.sleep(0.06)
+        self.assertEqual(func(), "ok")
+        self.assertIsNone(budget.opened_at)
+
+    def test_coroutine_uses_asyncio_sleep(self):
+        """The coroutine wrapper waits with asyncio.sleep, not time.sleep."""
+        async def func():
+            self.calls.append(1)
+            if len(self.calls) < 3:
+                raise LOCKED
+            return "ok"
+
+        wrapped = self.decorate(func)
+        with patch.object(retry.asyncio, "sleep", AsyncMock()) as sleep, \
+                patch.object(retry.time, "sleep") as blocking_sleep:
+            self.assertEqual(asyncio.run(wrapped()), "ok")
+        self.assertEqual(sleep.await_count, 2)
+        blocking_sleep.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Tests for transactional: savepoints and group commit."""
+import importlib
+import sqlite3
+import unittest
+
+import db
+from test_db import DatabaseTestCase
+
+transactions = importlib.import_module("2-transactional")
+transactional = transactions.transactional
+
+
+@transactional
+def rename(conn, user_id, name):
+    conn.execute("UPDATE users SET name = ? WHERE id = ?", (name, user_id))
+
+
+@transactional
+def rename_then_fail(conn, user_id, name):
+    rename(conn, user_id, name)
+    raise ValueError("rejected")
+
+
+@transactional
+def rename_both(conn, first, second):
+    rename(conn, 1, first)
+    try:
+        rename_then_fail(conn, 2, second)
+    except ValueError:
+        pass
+
+
+class TransactionTestCase(DatabaseTestCase):
+    """Fresh users table and a primary connection outside the pool."""
+
+    def setUp(self):
+        super().setUp()
+        self.create_users()
+        self.conn = db.connect(self.database)
+
+    def tearDown(self):
+        self.conn.close()
+        super().tearDown()
+
+    def names(self):
+        conn = sqlite3.connect(self.database)
+        try:
+            return [row[0] for row in
+                    conn.execute("SELECT name FROM users ORDER BY id")]
+        finally:
+            conn.close()
+
+
+class TestSavepoints(TransactionTestCase):
+    """Nested transactional calls run in savepoints of the outer call."""
+
+    def test_commit(self):
+        """A top-level call commits its writes."""
+        rename(self.conn, 1, "Alicia")
+        self.assertEqual(self.names(), ["Alicia", "Bob"])
+
+    def test_rollback(self):
+        """A failing top-level call rolls back its nested writes."""
+        with self.assertRaises(ValueError):
+            rename_then_fail(self.conn, 1, "Alicia")
+        self.assertEqual(self.names(), ["Alice", "Bob"])
+        self.assertFalse(self.conn.in_transaction)
+
+    def test_failed_nested_call(self):
+        """A failing nested call undoes only its own writes."""
+        rename_both(self.conn, "Alicia", "Robert")
+        self.assertEqual(self.names(), ["Alicia", "Bob"])
+
+
+class TestGroupCommit(TransactionTestCase):
+    """Batched calls share one commit and resolve their futures after it."""
+
+    def test_one_commit_per_batch(self):
+        """Calls in a GroupCommit block commit together."""
+        with transactions.GroupCommit(self.conn, max_delay=60) as batch:
+            futures = [rename(self.conn, 1, "Alicia"),
+                       rename(self.conn, 2, "Robert")]
+            self.assertFalse(any(future.done() for future in futures))
+            self.assertEqual(self.names(), ["Alice", "Bob"])
+        self.assertEqual(batch.commits, 1)
+        self.assertEqual(self.names(), ["Alicia", "Robert"])
+        self.assertTrue(all(future.done() for future in futures))
+
+    def test_failed_call_in_batch(self):
+        """A failing call fails its own future; the rest still commit."""
+        with transactions.GroupCommit(self.conn, max_delay=60):
+            failed = rename_then_fail(self.conn, 1, "Alicia")
+            renamed = rename(self.conn, 2, "Robert")
+        self.assertIsInstance(failed.exception(), ValueError)
+        self.assertIsNone(renamed.result())
+        self.assertEqual(self.names(), ["Alice", "Robert"])
+
+    def test_max_batch(self):
+        """A full batch commits without waiting for the block to end."""
+        with transactions.GroupCommit(self.conn, max_batch=2,
+                                      max_delay=60) as batch:
+            rename(self.conn, 1, "Alicia")
+            rename(self.conn, 2, "Robert")
+            self.assertEqual(self.names(), ["Alicia", "Robert"])
+        self.assertEqual(batch.commits, 1)
+
+    def test_batch_writer(self):
+        """BatchWriter runs calls from any thread on its own connection."""
+        writer = transactions.BatchWriter(
+            connect=lambda: db.connect(self.database)
+        )
+        try:
+            futures = [writer.submit(rename, 1, "Alicia"),
+                       writer.submit(rename, 2, "Robert")]
+            for future in futures:
+                future.result(timeout=5)
+        finally:
+            writer.close()
+        self.assertEqual(self.names(), ["Alicia", "Robert"])
+
+
+if __name__ == "__main__":
+    unittest.main()
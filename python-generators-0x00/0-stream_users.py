@@ -1,11 +1,31 @@
 #!/usr/bin/python3
-from seed import connect_to_prodev
+from rows import COMPACT_COLUMNS, UserRow
+from seed import pooled_connection
 
-def stream_users():
-    connection = connect_to_prodev()
-    cursor = connection.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM user_data;")
-    for row in cursor:
-        yield row
-    cursor.close()
-    connection.close()
+ROW_FORMATS = ("dict", "tuple", "compact")
+
+
+def stream_users(fetch_size=1000, row_format="dict"):
+    if row_format not in ROW_FORMATS:
+        raise ValueError(f"row_format must be one of {ROW_FORMATS}")
+    columns = COMPACT_COLUMNS if row_format == "compact" else "*"
+    # If the consumer stops early the connection goes back to the pool,
+    # whose reset_session() check decides its fate: a MySQL connection with
+    # unread rows fails the reset and is discarded, a SQLite one is rolled
+    # back and reused.
+    with pooled_connection() as connection:
+        # Unbuffered: rows stay on the server side of the socket until
+        # fetchmany() pulls the next chunk, so memory is bounded by fetch_size.
+        cursor = connection.cursor(
+            buffered=False, dictionary=row_format == "dict"
+        )
+        cursor.execute(f"SELECT {columns} FROM user_data;")
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            if row_format == "compact":
+                rows = map(UserRow.from_tuple, rows)
+            for row in rows:
+                yield row
+        cursor.close()
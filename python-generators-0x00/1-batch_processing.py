@@ -1,24 +1,104 @@
 #!/usr/bin/python3
-from seed import connect_to_prodev
-
-def stream_users_in_batches(batch_size):
-    connection = connect_to_prodev()
-    cursor = connection.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM user_data;")
-    batch = []
-    for row in cursor:
-        batch.append(row)
-        if len(batch) == batch_size:
+import operator
+
+from rows import COMPACT_COLUMNS, UserBatch, UserRow
+from seed import USER_COLUMNS, pooled_connection
+
+OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+BATCH_FORMATS = ("dicts", "columns")
+
+
+class Predicate:
+    def __init__(self, column, op, value):
+        if column not in USER_COLUMNS:
+            raise ValueError(f"Unknown column: {column!r}")
+        if op not in OPERATORS:
+            raise ValueError(f"Unsupported operator: {op!r}")
+        self.column = column
+        self.op = op
+        self.value = value
+
+    def __repr__(self):
+        return f"Predicate({self.column!r}, {self.op!r}, {self.value!r})"
+
+    def __call__(self, row):
+        return OPERATORS[self.op](row[self.column], self.value)
+
+    def sql(self):
+        return f"{self.column} {self.op} %s", (self.value,)
+
+
+def select_list(columns=None):
+    if columns is None:
+        return "*"
+    for column in columns:
+        if column not in USER_COLUMNS:
+            raise ValueError(f"Unknown column: {column!r}")
+    return ", ".join(columns)
+
+
+def compile_filters(where=()):
+    # Predicates become SQL; any other callable is evaluated in Python on
+    # the rows that come back, so it only sees the selected columns.
+    clauses, params, python_filters = [], [], []
+    for condition in where:
+        if isinstance(condition, Predicate):
+            clause, values = condition.sql()
+            clauses.append(clause)
+            params.extend(values)
+        else:
+            python_filters.append(condition)
+    return clauses, params, python_filters
+
+
+def stream_users_in_batches(batch_size, columns=None, where=(),
+                            batch_format="dicts"):
+    # "columns" yields UserBatch struct-of-arrays batches of every column;
+    # Python filters then see UserRow objects instead of dicts.
+    if batch_format not in BATCH_FORMATS:
+        raise ValueError(f"batch_format must be one of {BATCH_FORMATS}")
+    compact = batch_format == "columns"
+    if compact and columns is not None:
+        raise ValueError("columns batches always hold every user column")
+    clauses, params, python_filters = compile_filters(where)
+    selected = COMPACT_COLUMNS if compact else select_list(columns)
+    query = f"SELECT {selected} FROM user_data"
+    if clauses:
+        query += f" WHERE {' AND '.join(clauses)}"
+    new_batch = UserBatch if compact else list
+    with pooled_connection() as connection:
+        cursor = connection.cursor(buffered=False, dictionary=not compact)
+        cursor.execute(query + ";", params)
+        batch = new_batch()
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                if python_filters:
+                    candidate = UserRow.from_tuple(row) if compact else row
+                    if not all(check(candidate) for check in python_filters):
+                        continue
+                batch.append(row)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = new_batch()
+        if batch:
             yield batch
-            batch = []
-    if batch:
-        yield batch
-    cursor.close()
-    connection.close()
+        cursor.close()
+
 
 def batch_processing(batch_size):
-    for batch in stream_users_in_batches(batch_size):
+    over_25 = Predicate("age", ">", 25)
+    for batch in stream_users_in_batches(batch_size, where=[over_25]):
         for user in batch:
-            if user["age"] > 25:
-                yield user
+            yield user
     return None
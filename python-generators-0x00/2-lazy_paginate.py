@@ -1,22 +1,120 @@
 #!/usr/bin/python3
-from seed import connect_to_prodev
+import base64
+import binascii
+import json
+import queue
+import threading
+
+from seed import pooled_connection
+
 
 def paginate_users(page_size, offset):
-    connection = connect_to_prodev()
-    cursor = connection.cursor(dictionary=True)
-    cursor.execute(
-        f"SELECT * FROM user_data LIMIT {page_size} OFFSET {offset};"
-    )
-    rows = cursor.fetchall()
-    cursor.close()
-    connection.close()
+    with pooled_connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute(
+            f"SELECT * FROM user_data LIMIT {page_size} OFFSET {offset};"
+        )
+        rows = cursor.fetchall()
+        cursor.close()
     return rows
 
-def lazy_pagination(page_size):
-    offset = 0
-    while True:
-        rows = paginate_users(page_size, offset)
-        if not rows:
-            break
+
+def encode_page_token(user_id):
+    payload = json.dumps({"user_id": user_id}).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_page_token(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode()))["user_id"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise ValueError(f"Invalid page token: {token!r}") from None
+
+
+def page_token(page):
+    return encode_page_token(page[-1]["user_id"])
+
+
+def paginate_users_after(cursor, page_size, last_user_id=None):
+    # Seek on the primary key instead of skipping rows, so every page costs
+    # one index range scan of page_size rows regardless of its position.
+    if last_user_id is None:
+        cursor.execute(
+            "SELECT * FROM user_data ORDER BY user_id LIMIT %s;",
+            (page_size,)
+        )
+    else:
+        cursor.execute(
+            "SELECT * FROM user_data WHERE user_id > %s "
+            "ORDER BY user_id LIMIT %s;",
+            (last_user_id, page_size)
+        )
+    return cursor.fetchall()
+
+
+def keyset_pages(page_size, last_user_id=None):
+    with pooled_connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        while True:
+            rows = paginate_users_after(cursor, page_size, last_user_id)
+            if not rows:
+                break
+            last_user_id = rows[-1]["user_id"]
+            yield rows
+            if len(rows) < page_size:
+                break
+        cursor.close()
+
+
+def read_ahead(pages, depth):
+    # A background thread keeps up to `depth` pages fetched ahead of the
+    # consumer, so database round trips overlap with page processing.
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+    failure = []
+
+    def fetch():
+        try:
+            for page in pages:
+                buffer.put(page)
+                if stop.is_set():
+                    break
+        except Exception as exc:
+            failure.append(exc)
+        finally:
+            pages.close()
+            if not stop.is_set():
+                buffer.put(done)
+
+    worker = threading.Thread(target=fetch, daemon=True)
+    worker.start()
+    try:
+        while True:
+            page = buffer.get()
+            if page is done:
+                break
+            yield page
+        if failure:
+            raise failure[0]
+    finally:
+        # On early exit, draining after setting stop unblocks a pending
+        # put(); the worker then sees stop and returns its connection.
+        stop.set()
+        while True:
+            try:
+                buffer.get_nowait()
+            except queue.Empty:
+                break
+        worker.join()
+
+
+def lazy_pagination(page_size, resume_token=None, prefetch=0):
+    last_user_id = None
+    if resume_token is not None:
+        last_user_id = decode_page_token(resume_token)
+    pages = keyset_pages(page_size, last_user_id)
+    if prefetch > 0:
+        pages = read_ahead(pages, prefetch)
+    for rows in pages:
         yield rows
-        offset += page_size
@@ -1,22 +1,164 @@
 #!/usr/bin/python3
-from seed import connect_to_prodev
+import math
+from array import array
+from itertools import chain
+
+from seed import pooled_connection
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+STRATEGIES = ("sql", "columnar", "welford")
+
 
 def stream_user_ages():
-    connection = connect_to_prodev()
-    cursor = connection.cursor()
-    cursor.execute("SELECT age FROM user_data;")
-    for (age,) in cursor:
-        yield float(age)
-    cursor.close()
-    connection.close()
-
-def calculate_average_age():
-    total = 0
-    count = 0
-    for age in stream_user_ages():
-        total += age
-        count += 1
-    if count > 0:
-        print(f"Average age of users: {total / count:.2f}")
+    with pooled_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT age FROM user_data;")
+        for (age,) in cursor:
+            yield float(age)
+        cursor.close()
+
+
+def stream_age_chunks(chunk_size):
+    with pooled_connection() as connection:
+        cursor = connection.cursor(buffered=False)
+        # "+ 0E0" makes MySQL send DOUBLEs, so no Decimal is built per row.
+        cursor.execute("SELECT age + 0E0 FROM user_data;")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+        cursor.close()
+
+
+def nearest_rank(count, percentile):
+    return max(math.ceil(percentile / 100 * count), 1) - 1
+
+
+def bucket_of(age, bin_width):
+    return float(math.floor(age / bin_width) * bin_width)
+
+
+def sql_statistics(percentiles, bin_width):
+    with pooled_connection() as connection:
+        cursor = connection.cursor(buffered=True)
+        cursor.execute(
+            "SELECT COUNT(age), AVG(age), MIN(age), MAX(age), STDDEV_POP(age) "
+            "FROM user_data;"
+        )
+        count, mean, minimum, maximum, stddev = cursor.fetchone()
+        stats = {"count": count, "percentiles": {}, "histogram": {}}
+        if count:
+            stats.update(
+                mean=float(mean), min=float(minimum), max=float(maximum),
+                stddev=float(stddev)
+            )
+            for percentile in percentiles:
+                cursor.execute(
+                    "SELECT age FROM user_data ORDER BY age "
+                    "LIMIT 1 OFFSET %s;",
+                    (nearest_rank(count, percentile),)
+                )
+                stats["percentiles"][percentile] = float(cursor.fetchone()[0])
+            cursor.execute(
+                "SELECT FLOOR(age / %s) * %s AS bucket, COUNT(*) "
+                "FROM user_data GROUP BY bucket ORDER BY bucket;",
+                (bin_width, bin_width)
+            )
+            stats["histogram"] = {
+                float(bucket): total for bucket, total in cursor.fetchall()
+            }
+        cursor.close()
+    return stats
+
+
+def columnar_statistics(percentiles, bin_width, chunk_size):
+    if numpy is not None:
+        chunks = [
+            numpy.fromiter(chain.from_iterable(rows), float, len(rows))
+            for rows in stream_age_chunks(chunk_size)
+        ]
+        ages = numpy.concatenate(chunks) if chunks else numpy.empty(0)
+    else:
+        ages = array("d")
+        for rows in stream_age_chunks(chunk_size):
+            ages.extend(chain.from_iterable(rows))
+    count = len(ages)
+    stats = {"count": count, "percentiles": {}, "histogram": {}}
+    if not count:
+        return stats
+    if numpy is not None:
+        ages.sort()
+        mean = float(ages.mean())
+        stats.update(mean=mean, stddev=float(ages.std()))
+        buckets, totals = numpy.unique(
+            numpy.floor(ages / bin_width) * bin_width, return_counts=True
+        )
+        stats["histogram"] = dict(zip(buckets.tolist(), totals.tolist()))
+    else:
+        ages = sorted(ages)
+        mean = math.fsum(ages) / count
+        stats.update(
+            mean=mean,
+            stddev=math.sqrt(
+                math.fsum((age - mean) ** 2 for age in ages) / count
+            )
+        )
+        for age in ages:
+            bucket = bucket_of(age, bin_width)
+            stats["histogram"][bucket] = stats["histogram"].get(bucket, 0) + 1
+    stats.update(min=float(ages[0]), max=float(ages[-1]))
+    for percentile in percentiles:
+        stats["percentiles"][percentile] = float(
+            ages[nearest_rank(count, percentile)]
+        )
+    return stats
+
+
+def welford_statistics(bin_width, chunk_size):
+    # Exact one-pass mean/variance in O(1) memory. Percentiles need every
+    # value, so this strategy leaves them empty.
+    count, mean, m2 = 0, 0.0, 0.0
+    minimum, maximum = math.inf, -math.inf
+    histogram = {}
+    for rows in stream_age_chunks(chunk_size):
+        for (age,) in rows:
+            count += 1
+            delta = age - mean
+            mean += delta / count
+            m2 += delta * (age - mean)
+            minimum = min(minimum, age)
+            maximum = max(maximum, age)
+            bucket = bucket_of(age, bin_width)
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+    stats = {"count": count, "percentiles": {}, "histogram": {}}
+    if count:
+        stats.update(
+            mean=mean, min=minimum, max=maximum,
+            stddev=math.sqrt(m2 / count),
+            histogram=dict(sorted(histogram.items()))
+        )
+    return stats
+
+
+def age_statistics(strategy="sql", percentiles=(50, 90, 99), bin_width=10,
+                   chunk_size=10000):
+    if strategy == "sql":
+        return sql_statistics(percentiles, bin_width)
+    if strategy == "columnar":
+        return columnar_statistics(percentiles, bin_width, chunk_size)
+    if strategy == "welford":
+        return welford_statistics(bin_width, chunk_size)
+    raise ValueError(f"strategy must be one of {STRATEGIES}")
+
+
+def calculate_average_age(strategy="sql"):
+    stats = age_statistics(strategy, percentiles=())
+    if stats["count"] > 0:
+        print(f"Average age of users: {stats['mean']:.2f}")
     else:
         print("No users found.")
@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+)
+
+from seed import pooled_connection
+
+batch_processing = __import__('1-batch_processing')
+
+EXECUTORS = {"process": ProcessPoolExecutor, "thread": ThreadPoolExecutor}
+
+# Most rows a worker hands back per task. Longer ranges are scanned in
+# several tasks, and each of the workers * 2 ranges in the window holds at
+# most two chunks (one waiting for the consumer and the next one), however
+# large the table is.
+CHUNK_ROWS = 10000
+
+
+def key_ranges(partitions):
+    # user_id is a UUID, so its leading hex digits are uniformly spread and
+    # equal slices of the 0000-ffff prefix space give equal-sized ranges.
+    bounds = [
+        format(i * 0x10000 // partitions, "04x") for i in range(1, partitions)
+    ]
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def scan_range(low, high, where=(), columns=None, after=None, limit=None):
+    # Scans up to `limit` rows of [low, high) past user_id `after`. Returns
+    # the rows that pass the filters and the user_id to continue after, or
+    # None once the range is done.
+    clauses, params, python_filters = batch_processing.compile_filters(where)
+    if after is not None:
+        clauses.append("user_id > %s")
+        params.append(after)
+    elif low is not None:
+        clauses.append("user_id >= %s")
+        params.append(low)
+    if high is not None:
+        clauses.append("user_id < %s")
+        params.append(high)
+    where_sql = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    # The key is needed to continue the range; it is dropped again from
+    # the rows if it was not asked for.
+    keyed = columns is None or "user_id" in columns
+    selected = columns if keyed else ("user_id", *columns)
+    limit_sql = f" LIMIT {int(limit)}" if limit is not None else ""
+    rows = []
+    scanned = 0
+    last = None
+    # Each worker checks a connection out of its process's pool, so a
+    # worker keeps reusing one connection across the ranges it scans.
+    with pooled_connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute(
+            f"SELECT {batch_processing.select_list(selected)} FROM user_data"
+            f"{where_sql} ORDER BY user_id{limit_sql};",
+            params
+        )
+        for row in cursor:
+            scanned += 1
+            last = row["user_id"]
+            if all(check(row) for check in python_filters):
+                if not keyed:
+                    del row["user_id"]
+                rows.append(row)
+        cursor.close()
+    return rows, last if limit is not None and scanned == limit else None
+
+
+def is_over_25(user):
+    return user["age"] > 25
+
+
+class RangeScan:
+    # One key range being scanned: the chunk in flight, if any, and the
+    # finished chunk waiting for the consumer, if any.
+    def __init__(self, low, high, future):
+        self.low = low
+        self.high = high
+        self.future = future
+        self.rows = None
+
+
+def parallel_scan(where=(), columns=None, workers=4, partitions=None,
+                  ordered=True, executor="process", chunk_size=CHUNK_ROWS):
+    # Predicate conditions are pushed into each range query; other
+    # callables run inside the workers and, with the process executor, must
+    # be picklable, i.e. module-level functions rather than lambdas.
+    ranges = deque(key_ranges(partitions or workers * 4))
+    pool = EXECUTORS[executor](max_workers=workers)
+    # A window of ranges in key order, so a slow consumer does not let
+    # finished results pile up in memory.
+    active = deque()
+
+    def submit(low, high, after=None):
+        return pool.submit(
+            scan_range, low, high, where, columns, after, chunk_size
+        )
+
+    def collect(scan):
+        # A range's next chunk is submitted as soon as the previous one is
+        # collected, so every range in the window keeps a worker busy
+        # while the consumer works through earlier ranges.
+        rows, after = scan.future.result()
+        scan.rows = rows
+        scan.future = None if after is None else submit(
+            scan.low, scan.high, after
+        )
+
+    try:
+        while active or ranges:
+            while ranges and len(active) < workers * 2:
+                low, high = ranges.popleft()
+                active.append(RangeScan(low, high, submit(low, high)))
+            for scan in active:
+                if scan.rows is None and scan.future.done():
+                    collect(scan)
+            if ordered:
+                ready = active[0] if active[0].rows is not None else None
+            else:
+                ready = next(
+                    (scan for scan in active if scan.rows is not None), None
+                )
+            if ready is None:
+                wait(
+                    [scan.future for scan in active if scan.rows is None],
+                    return_when=FIRST_COMPLETED
+                )
+                continue
+            rows, ready.rows = ready.rows, None
+            if ready.future is None:
+                active.remove(ready)
+            yield from rows
+    finally:
+        pool.shutdown(cancel_futures=True)
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+
+from rows import COMPACT_COLUMNS, UserRow
+from seed import get_pool
+
+batch_processing = __import__('1-batch_processing')
+lazy_paginate = __import__('2-lazy_paginate')
+
+ROW_FORMATS = ("dict", "tuple", "compact")
+
+# One semaphore per event loop, sized to the pool, so streams queue on the
+# loop instead of parking executor threads inside pool.acquire(). Without
+# it, waiters could occupy every executor thread while the streams holding
+# connections need one to make progress.
+_slots = weakref.WeakKeyDictionary()
+
+
+def checkout_slots(pool):
+    loop = asyncio.get_running_loop()
+    if loop not in _slots:
+        _slots[loop] = asyncio.Semaphore(pool.size)
+    return _slots[loop]
+
+
+async def acquire(pool):
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, pool.acquire)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # The checkout still completes in its thread; hand the connection
+        # straight back instead of leaking it.
+        def give_back(done):
+            if not done.cancelled() and done.exception() is None:
+                loop.run_in_executor(None, pool.release, done.result())
+        future.add_done_callback(give_back)
+        raise
+
+
+@asynccontextmanager
+async def apooled_connection():
+    pool = get_pool()
+    async with checkout_slots(pool):
+        connection = await acquire(pool)
+        try:
+            yield connection
+        except BaseException:
+            await asyncio.to_thread(pool.release, connection, True)
+            raise
+        else:
+            await asyncio.to_thread(pool.release, connection)
+
+
+@asynccontextmanager
+async def aclosing(agen):
+    # contextlib.aclosing only exists from Python 3.10.
+    try:
+        yield agen
+    finally:
+        await agen.aclose()
+
+
+async def afetch_chunks(query, params=(), fetch_size=1000, dictionary=True):
+    # The blocking driver calls run on the default executor one chunk at a
+    # time; nothing is fetched until the consumer asks for the next chunk,
+    # which is what gives a slow consumer backpressure.
+    async with apooled_connection() as connection:
+        cursor = connection.cursor(buffered=False, dictionary=dictionary)
+        await asyncio.to_thread(cursor.execute, query, params)
+        while True:
+            rows = await asyncio.to_thread(cursor.fetchmany, fetch_size)
+            if not rows:
+                break
+            yield rows
+        cursor.close()
+
+
+async def astream_users(fetch_size=1000, row_format="dict"):
+    if row_format not in ROW_FORMATS:
+        raise ValueError(f"row_format must be one of {ROW_FORMATS}")
+    columns = COMPACT_COLUMNS if row_format == "compact" else "*"
+    chunks = afetch_chunks(
+        f"SELECT {columns} FROM user_data;", (), fetch_size,
+        row_format == "dict"
+    )
+    async with aclosing(chunks):
+        async for rows in chunks:
+            if row_format == "compact":
+                rows = map(UserRow.from_tuple, rows)
+            for row in rows:
+                yield row
+
+
+async def astream_users_in_batches(batch_size, columns=None, where=()):
+    clauses, params, python_filters = batch_processing.compile_filters(where)
+    query = f"SELECT {batch_processing.select_list(columns)} FROM user_data"
+    if clauses:
+        query += f" WHERE {' AND '.join(clauses)}"
+    chunks = afetch_chunks(query + ";", params, batch_size)
+    batch = []
+    async with aclosing(chunks):
+        async for rows in chunks:
+            for row in rows:
+                if all(check(row) for check in python_filters):
+                    batch.append(row)
+                    if len(batch) == batch_size:
+                        yield batch
+                        batch = []
+    if batch:
+        yield batch
+
+
+async def alazy_pagination(page_size, resume_token=None):
+    last_user_id = None
+    if resume_token is not None:
+        last_user_id = lazy_paginate.decode_page_token(resume_token)
+    async with apooled_connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        while True:
+            rows = await asyncio.to_thread(
+                lazy_paginate.paginate_users_after,
+                cursor, page_size, last_user_id
+            )
+            if not rows:
+                break
+            last_user_id = rows[-1]["user_id"]
+            yield rows
+            if len(rows) < page_size:
+                break
+        cursor.close()
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+import json
+import mmap
+import os
+import shutil
+import sys
+from array import array
+
+from seed import USER_COLUMNS
+
+stream_users_in_batches = __import__(
+    '1-batch_processing'
+).stream_users_in_batches
+
+# Arrow-style layout: fixed-width columns are one raw little-endian buffer,
+# strings are an int64 offsets buffer plus a UTF-8 data buffer.
+COLUMN_TYPES = {
+    "user_id": "utf8",
+    "name": "utf8",
+    "email": "utf8",
+    "age": "float64",
+}
+TYPECODES = {"float64": "d", "int64": "q"}
+
+
+class ColumnWriter:
+    def __init__(self, directory, column, kind):
+        self.column = column
+        self.kind = kind
+        base = os.path.join(directory, column)
+        if kind == "utf8":
+            self.offsets = open(f"{base}.offsets", "wb")
+            self.data = open(f"{base}.data", "wb")
+            self.position = 0
+            self.write_offsets(array("q", [0]))
+        else:
+            self.data = open(f"{base}.bin", "wb")
+
+    def write_offsets(self, offsets):
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        offsets.tofile(self.offsets)
+
+    def append(self, values):
+        if self.kind == "utf8":
+            encoded = [str(value).encode() for value in values]
+            offsets = array("q")
+            for value in encoded:
+                self.position += len(value)
+                offsets.append(self.position)
+            self.data.write(b"".join(encoded))
+            self.write_offsets(offsets)
+        else:
+            buffer = array(TYPECODES[self.kind], map(float, values))
+            if sys.byteorder != "little":
+                buffer.byteswap()
+            buffer.tofile(self.data)
+
+    def close(self):
+        self.data.close()
+        if self.kind == "utf8":
+            self.offsets.close()
+
+
+def export_users(path, columns=None, where=(), batch_size=10000):
+    columns = list(columns or USER_COLUMNS)
+    # Written into a sibling directory and renamed at the end, so readers
+    # never see a half-written export.
+    staging = f"{path}.partial"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    writers = [
+        ColumnWriter(staging, column, COLUMN_TYPES[column])
+        for column in columns
+    ]
+    rows = 0
+    try:
+        for batch in stream_users_in_batches(batch_size, columns, where):
+            for writer in writers:
+                writer.append([row[writer.column] for row in batch])
+            rows += len(batch)
+    finally:
+        for writer in writers:
+            writer.close()
+    with open(os.path.join(staging, "meta.json"), "w") as meta:
+        json.dump({
+            "rows": rows,
+            "columns": {column: COLUMN_TYPES[column] for column in columns},
+        }, meta)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(staging, path)
+    return rows
+
+
+def read_meta(path):
+    with open(os.path.join(path, "meta.json")) as meta:
+        return json.load(meta)
+
+
+def map_buffer(filename, typecode, use_mmap):
+    with open(filename, "rb") as handle:
+        size = os.fstat(handle.fileno()).st_size
+        # mmap cannot map an empty file, and a big-endian host needs a
+        # byteswapped copy anyway.
+        if use_mmap and size and sys.byteorder == "little":
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(mapped).cast(typecode)
+        buffer = array(typecode, handle.read())
+    if sys.byteorder != "little":
+        buffer.byteswap()
+    return buffer
+
+
+class StringColumn:
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("column index out of range")
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return bytes(self.data[start:end]).decode()
+
+
+def read_column(path, column, use_mmap=True):
+    # Only the requested column's files are touched, so reading `age` from
+    # a wide export costs 8 bytes per row.
+    kind = read_meta(path)["columns"][column]
+    if kind != "utf8":
+        return map_buffer(
+            os.path.join(path, f"{column}.bin"), TYPECODES[kind], use_mmap
+        )
+    offsets = map_buffer(
+        os.path.join(path, f"{column}.offsets"), "q", use_mmap
+    )
+    data = map_buffer(os.path.join(path, f"{column}.data"), "B", use_mmap)
+    return StringColumn(offsets, data)
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+import json
+import os
+from datetime import datetime, timedelta
+
+from seed import pooled_connection
+
+
+def load_watermark(path):
+    try:
+        with open(path) as handle:
+            saved = json.load(handle)
+    except FileNotFoundError:
+        return None
+    return datetime.fromisoformat(saved["updated_at"]), saved["user_id"]
+
+
+def save_watermark(path, watermark):
+    updated_at, user_id = watermark
+    # Write-then-rename so a crash never leaves a truncated watermark.
+    with open(f"{path}.tmp", "w") as handle:
+        json.dump(
+            {"updated_at": updated_at.isoformat(), "user_id": user_id}, handle
+        )
+    os.replace(f"{path}.tmp", path)
+
+
+def changes_after(cursor, watermark, until, batch_size):
+    if watermark is None:
+        cursor.execute(
+            "SELECT * FROM user_data WHERE updated_at <= %s "
+            "ORDER BY updated_at, user_id LIMIT %s;",
+            (until, batch_size)
+        )
+    else:
+        updated_at, user_id = watermark
+        cursor.execute(
+            "SELECT * FROM user_data "
+            "WHERE (updated_at > %s OR (updated_at = %s AND user_id > %s)) "
+            "AND updated_at <= %s "
+            "ORDER BY updated_at, user_id LIMIT %s;",
+            (updated_at, updated_at, user_id, until, batch_size)
+        )
+    return cursor.fetchall()
+
+
+def stream_changes(watermark_path, batch_size=1000, settle=1.0):
+    # Yields rows inserted or updated since the persisted watermark, in
+    # (updated_at, user_id) order. The watermark is saved once a batch has
+    # been fully consumed, so a crash replays at most one batch.
+    #
+    # Rows newer than NOW() - settle are left for the next run: a
+    # transaction that commits late can carry an updated_at older than rows
+    # already visible, and the settle window keeps it from being skipped.
+    watermark = load_watermark(watermark_path)
+    with pooled_connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute("SELECT NOW(6) AS now;")
+        now = cursor.fetchone()["now"]
+        if isinstance(now, str):
+            # SQLite computes NOW() in a user function, which returns text.
+            now = datetime.fromisoformat(now)
+        until = now - timedelta(seconds=settle)
+        while True:
+            rows = changes_after(cursor, watermark, until, batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+            watermark = rows[-1]["updated_at"], rows[-1]["user_id"]
+            save_watermark(watermark_path, watermark)
+            if len(rows) < batch_size:
+                break
+        cursor.close()
@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+import math
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+# SQLite keeps timestamps as text in this exact format, so values compare
+# correctly as strings and round-trip through datetime unchanged.
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%f000"
+
+sqlite3.register_adapter(
+    datetime, lambda value: value.isoformat(" ", timespec="microseconds")
+)
+sqlite3.register_converter(
+    "TIMESTAMP", lambda value: datetime.fromisoformat(value.decode())
+)
+
+
+class MySQLBackend:
+    name = "mysql"
+    supports_load_data = True
+
+    create_table_statements = ("""
+    CREATE TABLE IF NOT EXISTS user_data (
+        user_id CHAR(36) PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        email VARCHAR(255) NOT NULL,
+        age DECIMAL NOT NULL,
+        updated_at TIMESTAMP(6) NOT NULL
+            DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+        INDEX idx_user_data_changes (updated_at, user_id)
+    );
+    """,)
+
+    change_tracking_statements = (
+        "ALTER TABLE user_data "
+        "ADD COLUMN updated_at TIMESTAMP(6) NOT NULL "
+        "DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6), "
+        "ADD INDEX idx_user_data_changes (updated_at, user_id);",
+    )
+
+    upsert_user_sql = """
+    INSERT INTO user_data (user_id, name, email, age)
+    VALUES (%s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        name = VALUES(name), email = VALUES(email), age = VALUES(age)
+    """
+
+    def __init__(self, host="localhost", user="root",
+                 password="yourpassword", database="ALX_prodev"):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.database = database
+
+    def connect_server(self):
+        import mysql.connector
+        return mysql.connector.connect(
+            host=self.host,
+            user=self.user,
+            password=self.password
+        )
+
+    def connect(self, **kwargs):
+        import mysql.connector
+        return mysql.connector.connect(
+            host=self.host,
+            user=self.user,
+            password=self.password,
+            database=self.database,
+            **kwargs
+        )
+
+    @property
+    def create_database_statements(self):
+        return (f"CREATE DATABASE IF NOT EXISTS {self.database};",)
+
+    def has_column(self, cursor, table, column):
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.columns "
+            "WHERE table_schema = DATABASE() AND table_name = %s "
+            "AND column_name = %s;",
+            (table, column)
+        )
+        return bool(cursor.fetchone()[0])
+
+
+class StddevPop:
+    # Welford aggregate standing in for MySQL's STDDEV_POP().
+    def __init__(self):
+        self.count, self.mean, self.m2 = 0, 0.0, 0.0
+
+    def step(self, value):
+        if value is None:
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def finalize(self):
+        return math.sqrt(self.m2 / self.count) if self.count else None
+
+
+class SQLiteCursor:
+    # Speaks the subset of the mysql.connector cursor API the generators
+    # use: %s placeholders and optional dictionary rows.
+    def __init__(self, cursor, dictionary=False):
+        self._cursor = cursor
+        self._dictionary = dictionary
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def _row(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return dict(zip([column[0] for column in self.description], row))
+
+    def execute(self, query, params=()):
+        self._cursor.execute(query.replace("%s", "?"), tuple(params))
+
+    def executemany(self, query, seq_of_params):
+        self._cursor.executemany(query.replace("%s", "?"), seq_of_params)
+
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
+
+    def fetchmany(self, size=1):
+        return [self._row(row) for row in self._cursor.fetchmany(size)]
+
+    def fetchall(self):
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+    def __iter__(self):
+        for row in self._cursor:
+            yield self._row(row)
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self, buffered=None, dictionary=False):
+        # SQLite cursors already step through rows on demand, so there is
+        # no separate unbuffered mode.
+        return SQLiteCursor(self._connection.cursor(), dictionary)
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def close(self):
+        self._connection.close()
+
+    def is_connected(self):
+        try:
+            self._connection.execute("SELECT 1;")
+        except sqlite3.Error:
+            return False
+        return True
+
+    def reset_session(self):
+        if self._connection.in_transaction:
+            self._connection.rollback()
+
+
+class SQLiteBackend:
+    name = "sqlite"
+    supports_load_data = False
+    create_database_statements = ()
+
+    create_table_statements = (
+        f"""
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id CHAR(36) PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            email VARCHAR(255) NOT NULL,
+            age DECIMAL NOT NULL,
+            updated_at TIMESTAMP NOT NULL
+                DEFAULT (strftime('{TIMESTAMP_FORMAT}', 'now'))
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_user_data_changes
+        ON user_data (updated_at, user_id);
+        """,
+        # SQLite has no ON UPDATE clause; the trigger stands in for it.
+        f"""
+        CREATE TRIGGER IF NOT EXISTS user_data_touch
+        AFTER UPDATE OF user_id, name, email, age ON user_data
+        BEGIN
+            UPDATE user_data
+            SET updated_at = strftime('{TIMESTAMP_FORMAT}', 'now')
+            WHERE user_id = NEW.user_id;
+        END;
+        """,
+    )
+
+    # ALTER TABLE cannot add a column with a non-constant default, so
+    # existing rows get a fixed epoch and new writes go through the trigger.
+    change_tracking_statements = (
+        "ALTER TABLE user_data ADD COLUMN updated_at TIMESTAMP NOT NULL "
+        "DEFAULT '1970-01-01 00:00:00.000000';",
+    ) + create_table_statements[1:]
+
+    # Like MySQL, leave rows that did not change untouched so the change
+    # feed only sees real updates.
+    upsert_user_sql = """
+    INSERT INTO user_data (user_id, name, email, age)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (user_id) DO UPDATE SET
+        name = excluded.name, email = excluded.email, age = excluded.age
+    WHERE name IS NOT excluded.name OR email IS NOT excluded.email
+        OR age IS NOT excluded.age
+    """
+
+    def __init__(self, path="ALX_prodev.db", mmap_size=256 * 1024 * 1024,
+                 cache_size_kb=65536):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.cache_size_kb = cache_size_kb
+
+    def connect_server(self):
+        return self.connect()
+
+    def connect(self, **kwargs):
+        connection = sqlite3.connect(
+            self.path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False
+        )
+        # Tuned for read-heavy scans: WAL lets readers run alongside a
+        # writer, mmap serves pages without read() copies, and a large page
+        # cache keeps hot pages resident.
+        connection.execute("PRAGMA journal_mode = WAL;")
+        connection.execute("PRAGMA synchronous = NORMAL;")
+        connection.execute(f"PRAGMA mmap_size = {int(self.mmap_size)};")
+        connection.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)};")
+        connection.execute("PRAGMA temp_store = MEMORY;")
+        connection.create_aggregate("STDDEV_POP", 1, StddevPop)
+        connection.create_function(
+            "FLOOR", 1, lambda value: None if value is None
+            else math.floor(value), deterministic=True
+        )
+        # strftime('now') is UTC, so NOW() is too.
+        connection.create_function(
+            "NOW", 1,
+            lambda precision: datetime.now(timezone.utc).replace(
+                tzinfo=None
+            ).isoformat(" ", timespec="microseconds")
+        )
+        return SQLiteConnection(connection)
+
+    def has_column(self, cursor, table, column):
+        cursor.execute(f"PRAGMA table_info({table});")
+        return any(row[1] == column for row in cursor.fetchall())
+
+
+BACKENDS = {"mysql": MySQLBackend, "sqlite": SQLiteBackend}
+
+
+def backend_from_env():
+    name = os.environ.get("PRODEV_BACKEND", "mysql")
+    if name == "sqlite":
+        return SQLiteBackend(
+            os.environ.get("PRODEV_SQLITE_PATH", "ALX_prodev.db")
+        )
+    if name == "mysql":
+        return MySQLBackend()
+    raise ValueError(f"PRODEV_BACKEND must be one of {tuple(BACKENDS)}")
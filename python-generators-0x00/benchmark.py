@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import islice
+
+import seed
+from backends import BACKENDS, backend_from_env
+from seed import pooled_connection
+
+stream_users = __import__('0-stream_users').stream_users
+stream_users_in_batches = __import__(
+    '1-batch_processing'
+).stream_users_in_batches
+lazy_paginate = __import__('2-lazy_paginate')
+stream_ages = __import__('4-stream_ages')
+
+ROW_COUNTS = (10_000, 100_000, 1_000_000)
+SUITE_SIZES = (10_000, 1_000_000, 10_000_000)
+PREFETCH_DEPTHS = (0, 1, 2, 4, 8)
+
+# Each strategy is an iterable of rows or of lists of rows.
+STRATEGIES = {
+    "stream_users": lambda: stream_users(),
+    "stream_users_tuple": lambda: stream_users(row_format="tuple"),
+    "stream_users_in_batches": lambda: stream_users_in_batches(1000),
+    "lazy_pagination": lambda: lazy_paginate.lazy_pagination(1000),
+    "lazy_pagination_prefetch": lambda: lazy_paginate.lazy_pagination(
+        1000, prefetch=2
+    ),
+    "stream_user_ages": lambda: stream_ages.stream_user_ages(),
+}
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_child(*args):
+    # Each measurement runs in a fresh interpreter because ru_maxrss only
+    # ever grows within a process.
+    output = subprocess.check_output(
+        [sys.executable, __file__, "child", *map(str, args)]
+    )
+    return json.loads(output)
+
+
+def consume_buffered(rows):
+    # The pre-streaming behaviour: a buffered dictionary cursor that pulls
+    # the whole result set into the client before the first row.
+    with pooled_connection() as connection:
+        cursor = connection.cursor(buffered=True, dictionary=True)
+        cursor.execute("SELECT * FROM user_data LIMIT %s;", (rows,))
+        for _ in cursor:
+            pass
+        cursor.close()
+
+
+def consume_streamed(rows, fetch_size):
+    for _ in islice(stream_users(fetch_size=fetch_size), rows):
+        pass
+
+
+def run_strategy(name):
+    rows = 0
+    first_row = None
+    started = time.perf_counter()
+    for item in STRATEGIES[name]():
+        if first_row is None:
+            first_row = time.perf_counter() - started
+        rows += len(item) if isinstance(item, list) else 1
+    elapsed = time.perf_counter() - started
+    return {
+        "strategy": name,
+        "rows": rows,
+        "seconds": elapsed,
+        "rows_per_sec": rows / elapsed if elapsed else 0.0,
+        "time_to_first_row": first_row,
+        "connections": seed.pool_metrics()["misses"],
+    }
+
+
+def child(mode, *args):
+    if mode == "buffered":
+        consume_buffered(int(args[0]))
+        result = {}
+    elif mode == "streamed":
+        consume_streamed(int(args[0]), int(args[1]))
+        result = {}
+    else:
+        result = run_strategy(args[0])
+    result["peak_rss_kb"] = peak_rss_kb()
+    print(json.dumps(result))
+
+
+def synthesize_csv(path, rows, seed_value=0):
+    generator = random.Random(seed_value)
+    with open(path, "w", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(("name", "email", "age"))
+        for i in range(rows):
+            writer.writerow(
+                (f"user{i}", f"user{i}@example.com", generator.randint(18, 90))
+            )
+
+
+def seed_table(rows):
+    with pooled_connection() as connection:
+        seed.create_table(connection)
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM user_data;")
+        connection.commit()
+        cursor.close()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "user_data.csv")
+            synthesize_csv(path, rows)
+            seed.insert_data(connection, path, chunk_size=10000)
+
+
+def compare(baseline_path, report, tolerance):
+    with open(baseline_path) as handle:
+        baseline = {
+            (result["table_rows"], result["strategy"]): result
+            for result in json.load(handle)["results"]
+        }
+    regressions = []
+    for result in report["results"]:
+        previous = baseline.get((result["table_rows"], result["strategy"]))
+        if previous is None:
+            continue
+        key = f"{result['strategy']} @ {result['table_rows']} rows"
+        if result["rows_per_sec"] < previous["rows_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{key}: {previous['rows_per_sec']:,.0f} -> "
+                f"{result['rows_per_sec']:,.0f} rows/s"
+            )
+        if result["peak_rss_kb"] > previous["peak_rss_kb"] * (1 + tolerance):
+            regressions.append(
+                f"{key}: {previous['peak_rss_kb']} -> "
+                f"{result['peak_rss_kb']} KB peak RSS"
+            )
+    return regressions
+
+
+def suite(sizes, output, baseline=None, tolerance=0.2):
+    results = []
+    for size in sizes:
+        seed_table(size)
+        for name in STRATEGIES:
+            result = dict(run_child("run", name), table_rows=size)
+            results.append(result)
+            print(
+                f"{size:>10} {name:>26} {result['rows_per_sec']:>12,.0f} "
+                f"rows/s  ttfr {result['time_to_first_row'] or 0:.4f}s  "
+                f"rss {result['peak_rss_kb']} KB  "
+                f"conns {result['connections']}"
+            )
+    report = {
+        "backend": seed.BACKEND.name,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "results": results,
+    }
+    with open(output, "w") as handle:
+        json.dump(report, handle, indent=2)
+    print(f"Results written to {output}")
+    if baseline is None:
+        return 0
+    regressions = compare(baseline, report, tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    return 1 if regressions else 0
+
+
+def memory(fetch_size=1000):
+    print(f"{'rows':>10} {'buffered KB':>12} {'streamed KB':>12}")
+    for rows in ROW_COUNTS:
+        buffered = run_child("buffered", rows)["peak_rss_kb"]
+        streamed = run_child("streamed", rows, fetch_size)["peak_rss_kb"]
+        print(f"{rows:>10} {buffered:>12} {streamed:>12}")
+
+
+def ages(chunk_size=10000):
+    print(f"{'strategy':>10} {'seconds':>9} {'mean':>8} {'stddev':>8}")
+    for strategy in stream_ages.STRATEGIES:
+        started = time.perf_counter()
+        stats = stream_ages.age_statistics(strategy, chunk_size=chunk_size)
+        elapsed = time.perf_counter() - started
+        print(
+            f"{strategy:>10} {elapsed:>9.3f} "
+            f"{stats.get('mean', 0):>8.2f} {stats.get('stddev', 0):>8.2f}"
+        )
+
+
+def prefetch(page_size=1000, pages=200, work_ms=5):
+    # The consumer sleeps per page to stand in for real processing; with
+    # read-ahead the next fetch overlaps that time.
+    print(f"{'depth':>6} {'seconds':>9} {'rows/sec':>12}")
+    for depth in PREFETCH_DEPTHS:
+        rows = 0
+        started = time.perf_counter()
+        walk = lazy_paginate.lazy_pagination(page_size, prefetch=depth)
+        for page in islice(walk, pages):
+            rows += len(page)
+            time.sleep(work_ms / 1000)
+        walk.close()
+        elapsed = time.perf_counter() - started
+        print(f"{depth:>6} {elapsed:>9.3f} {rows / elapsed:>12,.0f}")
+
+
+def held_bytes(build):
+    # Bytes still allocated while the built object is alive, i.e. the cost
+    # of keeping a buffered batch in memory.
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    held = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del held
+    return size
+
+
+def row_memory(rows=100_000):
+    forms = {
+        "dict": lambda: list(islice(stream_users(row_format="dict"), rows)),
+        "tuple": lambda: list(islice(stream_users(row_format="tuple"), rows)),
+        "compact": lambda: list(
+            islice(stream_users(row_format="compact"), rows)
+        ),
+        "columns": lambda: next(
+            stream_users_in_batches(rows, batch_format="columns")
+        ),
+    }
+    print(f"{'format':>8} {'bytes/row':>10} {'total MB':>9}")
+    for name, build in forms.items():
+        size = held_bytes(build)
+        print(f"{name:>8} {size / rows:>10.0f} {size / 2 ** 20:>9.1f}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=BACKENDS, default=None)
+    parser.add_argument("--sqlite-path", default=None)
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("suite")
+    command.add_argument("--sizes", type=int, nargs="+", default=SUITE_SIZES)
+    command.add_argument("--output", default="benchmark_results.json")
+    command.add_argument("--baseline")
+    command.add_argument("--tolerance", type=float, default=0.2)
+    command = commands.add_parser("memory")
+    command.add_argument("fetch_size", type=int, nargs="?", default=1000)
+    command = commands.add_parser("ages")
+    command.add_argument("chunk_size", type=int, nargs="?", default=10000)
+    command = commands.add_parser("prefetch")
+    command.add_argument("page_size", type=int, nargs="?", default=1000)
+    command = commands.add_parser("rows")
+    command.add_argument("rows", type=int, nargs="?", default=100_000)
+    command = commands.add_parser("child")
+    command.add_argument("mode")
+    command.add_argument("args", nargs="*")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    # Set through the environment so child interpreters pick up the same
+    # backend.
+    if args.backend:
+        os.environ["PRODEV_BACKEND"] = args.backend
+    if args.sqlite_path:
+        os.environ["PRODEV_SQLITE_PATH"] = args.sqlite_path
+    seed.use_backend(backend_from_env())
+    if args.command == "suite":
+        sys.exit(suite(args.sizes, args.output, args.baseline, args.tolerance))
+    elif args.command == "memory":
+        memory(args.fetch_size)
+    elif args.command == "ages":
+        ages(args.chunk_size)
+    elif args.command == "prefetch":
+        prefetch(args.page_size)
+    elif args.command == "rows":
+        row_memory(args.rows)
+    else:
+        child(args.mode, *args.args)
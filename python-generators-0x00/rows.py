@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+import uuid
+from array import array
+
+# Column order expected by from_tuple() and UserBatch.append().
+COMPACT_COLUMNS = "user_id, name, email, age"
+
+
+def pack_user_id(user_id):
+    return bytes.fromhex(user_id.replace("-", ""))
+
+
+class UserRow:
+    # No per-row hash table, the UUID as 16 raw bytes instead of a
+    # 36-character string, and age as an int rather than a Decimal.
+    __slots__ = ("user_key", "name", "email", "age")
+
+    def __init__(self, user_key, name, email, age):
+        self.user_key = user_key
+        self.name = name
+        self.email = email
+        self.age = age
+
+    @classmethod
+    def from_tuple(cls, row):
+        user_id, name, email, age = row
+        return cls(pack_user_id(user_id), name, email, int(age))
+
+    @property
+    def user_id(self):
+        return str(uuid.UUID(bytes=self.user_key))
+
+    def __getitem__(self, column):
+        # Lets dict-style filters such as Predicate run on compact rows.
+        return getattr(self, column)
+
+    def __eq__(self, other):
+        if not isinstance(other, UserRow):
+            return NotImplemented
+        return self.as_tuple() == other.as_tuple()
+
+    def __repr__(self):
+        return (
+            f"UserRow(user_id={self.user_id!r}, name={self.name!r}, "
+            f"email={self.email!r}, age={self.age!r})"
+        )
+
+    def as_tuple(self):
+        return self.user_key, self.name, self.email, self.age
+
+    def as_dict(self):
+        return {
+            "user_id": self.user_id,
+            "name": self.name,
+            "email": self.email,
+            "age": self.age,
+        }
+
+
+class UserBatch:
+    # Struct-of-arrays batch: user ids packed back to back in one bytearray
+    # and ages in a typed array, with UserRow views built only on access.
+    __slots__ = ("user_keys", "names", "emails", "ages")
+
+    def __init__(self):
+        self.user_keys = bytearray()
+        self.names = []
+        self.emails = []
+        self.ages = array("i")
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("batch index out of range")
+        return UserRow(
+            bytes(self.user_keys[index * 16:index * 16 + 16]),
+            self.names[index], self.emails[index], self.ages[index]
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def append(self, row):
+        user_id, name, email, age = row
+        self.user_keys += pack_user_id(user_id)
+        self.names.append(name)
+        self.emails.append(email)
+        self.ages.append(int(age))
@@ -1,55 +1,344 @@
 #!/usr/bin/python3
-import mysql.connector
 import csv
+import os
+import threading
+import time
 import uuid
+from contextlib import contextmanager
+
+from backends import backend_from_env
+
+USER_COLUMNS = ("user_id", "name", "email", "age")
+
+# user_id is derived from the email so re-running a load upserts the same
+# rows instead of inserting duplicates under fresh random ids.
+USER_ID_NAMESPACE = uuid.UUID("6f1d3c2e-8a4b-4f0e-9c57-2b1e7d4a9f30")
+
+# MySQL by default; PRODEV_BACKEND=sqlite (with PRODEV_SQLITE_PATH) runs
+# every generator against a local SQLite file instead.
+BACKEND = backend_from_env()
+
+
+def use_backend(backend):
+    global BACKEND
+    BACKEND = backend
+    configure_pool()
+
 
 def connect_db():
-    return mysql.connector.connect(
-        host="localhost",
-        user="root",
-        password="yourpassword"
-    )
+    return BACKEND.connect_server()
+
 
 def create_database(connection):
     cursor = connection.cursor()
-    cursor.execute("CREATE DATABASE IF NOT EXISTS ALX_prodev;")
+    for statement in BACKEND.create_database_statements:
+        cursor.execute(statement)
     cursor.close()
 
-def connect_to_prodev():
-    return mysql.connector.connect(
-        host="localhost",
-        user="root",
-        password="yourpassword",
-        database="ALX_prodev"
-    )
+
+def connect_to_prodev(**kwargs):
+    return BACKEND.connect(**kwargs)
+
+
+class PoolExhausted(RuntimeError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, connect, size=8, max_idle=300.0, ping_after=1.0,
+                 timeout=30.0):
+        self.connect = connect
+        self.size = size
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self.timeout = timeout
+        self._idle = []
+        self._open = 0
+        self._condition = threading.Condition()
+        self._metrics = {
+            "hits": 0, "misses": 0, "waits": 0, "wait_time": 0.0,
+            "discarded": 0,
+        }
+
+    def acquire(self):
+        started = time.perf_counter()
+        while True:
+            connection, idle_for = self._checkout(started)
+            if connection is None:
+                break
+            # Idle connections are pinged before reuse, except ones that
+            # were handed back moments ago.
+            if idle_for > self.max_idle or (
+                idle_for > self.ping_after and not connection.is_connected()
+            ):
+                self._discard(connection)
+                continue
+            with self._condition:
+                self._metrics["hits"] += 1
+            return connection
+        try:
+            return self.connect()
+        except Exception:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+    def _checkout(self, started):
+        with self._condition:
+            waited = False
+            while not self._idle and self._open >= self.size:
+                waited = True
+                remaining = self.timeout - (time.perf_counter() - started)
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    raise PoolExhausted(
+                        f"No connection available within {self.timeout}s"
+                    )
+            if waited:
+                self._metrics["waits"] += 1
+                self._metrics["wait_time"] += time.perf_counter() - started
+            if self._idle:
+                connection, returned_at = self._idle.pop()
+                return connection, time.monotonic() - returned_at
+            self._open += 1
+            self._metrics["misses"] += 1
+            return None, 0.0
+
+    def release(self, connection, discard=False):
+        if not discard:
+            try:
+                # Clears session variables, temporary tables and any open
+                # transaction; fails if a streamed result was left unread.
+                connection.reset_session()
+            except Exception:
+                discard = True
+        if discard:
+            self._discard(connection)
+            return
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._open -= 1
+            self._metrics["discarded"] += 1
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._discard(connection)
+
+    def metrics(self):
+        with self._condition:
+            metrics = dict(
+                self._metrics, open=self._open, idle=len(self._idle)
+            )
+        checkouts = metrics["hits"] + metrics["misses"]
+        metrics["hit_rate"] = (
+            metrics["hits"] / checkouts if checkouts else 0.0
+        )
+        return metrics
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def configure_pool(**kwargs):
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+        _pool = ConnectionPool(connect_to_prodev, **kwargs)
+        _pool_pid = os.getpid()
+        return _pool
+
+
+def get_pool():
+    # Keyed on the pid so a forked worker never reuses its parent's sockets.
+    if _pool is None or _pool_pid != os.getpid():
+        return configure_pool()
+    return _pool
+
+
+@contextmanager
+def pooled_connection():
+    pool = get_pool()
+    connection = pool.acquire()
+    try:
+        yield connection
+    except GeneratorExit:
+        # A generator closed early; reset_session() decides whether the
+        # connection is still clean enough to reuse.
+        pool.release(connection)
+        raise
+    except BaseException:
+        pool.release(connection, discard=True)
+        raise
+    else:
+        pool.release(connection)
+
+
+def pool_metrics():
+    return get_pool().metrics()
+
 
 def create_table(connection):
     cursor = connection.cursor()
-    create_table_query = """
-    CREATE TABLE IF NOT EXISTS user_data (
-        user_id CHAR(36) PRIMARY KEY,
-        name VARCHAR(255) NOT NULL,
-        email VARCHAR(255) NOT NULL,
-        age DECIMAL NOT NULL
-    );
-    """
-    cursor.execute(create_table_query)
+    for statement in BACKEND.create_table_statements:
+        cursor.execute(statement)
     connection.commit()
     cursor.close()
     print("Table user_data created successfully")
 
-def insert_data(connection, filename):
+
+def add_change_tracking(connection):
+    # Upgrades a user_data table created before updated_at existed. Only
+    # rows that really change get a new updated_at, so re-running an
+    # idempotent load does not show up in the change feed.
     cursor = connection.cursor()
+    if not BACKEND.has_column(cursor, "user_data", "updated_at"):
+        for statement in BACKEND.change_tracking_statements:
+            cursor.execute(statement)
+        connection.commit()
+    cursor.close()
+
+
+def user_id_for(email):
+    return str(uuid.uuid5(USER_ID_NAMESPACE, email))
+
+
+def read_csv_chunks(filename, chunk_size):
     with open(filename, newline='') as csvfile:
         reader = csv.DictReader(csvfile)
+        chunk = []
         for row in reader:
-            user_id = str(uuid.uuid4())
-            cursor.execute(
-                """
-                INSERT INTO user_data (user_id, name, email, age)
-                VALUES (%s, %s, %s, %s)
-                """,
-                (user_id, row["name"], row["email"], row["age"])
-            )
-    connection.commit()
+            user_id = row.get("user_id") or user_id_for(row["email"])
+            chunk.append((user_id, row["name"], row["email"], row["age"]))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def report_progress(rows, started):
+    elapsed = time.perf_counter() - started
+    rate = rows / elapsed if elapsed else 0.0
+    print(f"Loaded {rows} rows in {elapsed:.1f}s ({rate:,.0f} rows/sec)")
+
+
+def insert_data(connection, filename, chunk_size=5000, progress=False):
+    cursor = connection.cursor()
+    started = time.perf_counter()
+    total = 0
+    for chunk in read_csv_chunks(filename, chunk_size):
+        # executemany rewrites the INSERT into one multi-row statement per
+        # chunk; committing per chunk keeps the transaction small, and the
+        # upsert makes an interrupted load safe to re-run.
+        cursor.executemany(BACKEND.upsert_user_sql, chunk)
+        connection.commit()
+        total += len(chunk)
+        if progress:
+            report_progress(total, started)
     cursor.close()
+    return total
+
+
+def user_id_sql(email_expr):
+    # SQL twin of user_id_for(): a name-based UUIDv5 built from SHA1 so
+    # LOAD DATA produces the same keys as the executemany path.
+    digest = f"SHA1(CONCAT(UNHEX('{USER_ID_NAMESPACE.hex}'), {email_expr}))"
+    return (
+        f"LOWER(CONCAT_WS('-', SUBSTR({digest}, 1, 8), "
+        f"SUBSTR({digest}, 9, 4), "
+        f"CONCAT('5', SUBSTR({digest}, 14, 3)), "
+        f"CONCAT(HEX((CONV(SUBSTR({digest}, 17, 1), 16, 10) & 3) | 8), "
+        f"SUBSTR({digest}, 18, 3)), "
+        f"SUBSTR({digest}, 21, 12)))"
+    )
+
+
+# LOAD DATA fills this first; it is then merged into user_data with the
+# same upsert as the executemany path.
+LOAD_STAGING_TABLE = """
+CREATE TEMPORARY TABLE user_data_load (
+    user_id CHAR(36) PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    email VARCHAR(255) NOT NULL,
+    age DECIMAL NOT NULL
+);
+"""
+
+
+def load_data_infile(connection, filename, progress=False):
+    # Fast path for very large files; the connection must be opened with
+    # connect_to_prodev(allow_local_infile=True) and the server must have
+    # local_infile enabled. Backends without LOAD DATA use the chunked path.
+    #
+    # LOAD DATA ... REPLACE straight into user_data would delete and
+    # re-insert every existing row, bumping updated_at on unchanged rows
+    # and counting each replaced row twice. Merging from a staging table
+    # with ON DUPLICATE KEY UPDATE only touches rows that really change.
+    if not BACKEND.supports_load_data:
+        return insert_data(connection, filename, progress=progress)
+    with open(filename, newline='') as csvfile:
+        header = next(csv.reader(csvfile))
+    variables = [
+        f"@{column}" if column in USER_COLUMNS else "@unused"
+        for column in header
+    ]
+    assignments = [
+        "name = @name",
+        "email = @email",
+        r"age = TRIM(TRAILING '\r' FROM @age)",
+    ]
+    if "user_id" in header:
+        assignments.insert(0, "user_id = @user_id")
+    else:
+        assignments.insert(0, f"user_id = {user_id_sql('@email')}")
+    cursor = connection.cursor()
+    started = time.perf_counter()
+    cursor.execute(LOAD_STAGING_TABLE)
+    try:
+        # REPLACE here only settles ids repeated within the file: the last
+        # row wins, as with executemany.
+        cursor.execute(
+            f"""
+            LOAD DATA LOCAL INFILE %s
+            REPLACE INTO TABLE user_data_load
+            CHARACTER SET utf8mb4
+            FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+            LINES TERMINATED BY '\\n'
+            IGNORE 1 LINES
+            ({", ".join(variables)})
+            SET {", ".join(assignments)}
+            """,
+            (filename,)
+        )
+        # Rows loaded, as insert_data() counts them (an id repeated in the
+        # file counts once); the merge's own rowcount counts updated rows
+        # twice and unchanged rows not at all.
+        cursor.execute("SELECT COUNT(*) FROM user_data_load;")
+        total = cursor.fetchone()[0]
+        cursor.execute(
+            "INSERT INTO user_data (user_id, name, email, age) "
+            "SELECT user_id, name, email, age FROM user_data_load "
+            "ON DUPLICATE KEY UPDATE "
+            "name = VALUES(name), email = VALUES(email), age = VALUES(age);"
+        )
+        connection.commit()
+    finally:
+        cursor.execute("DROP TEMPORARY TABLE IF EXISTS user_data_load;")
+        cursor.close()
+    if progress:
+        report_progress(total, started)
+    return total
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""Tests for the generators against a seeded SQLite database."""
+import contextlib
+import csv
+import importlib
+import io
+import math
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+import seed
+from backends import SQLiteBackend
+
+stream_users = importlib.import_module("0-stream_users").stream_users
+paginate = importlib.import_module("2-lazy_paginate")
+ages = importlib.import_module("4-stream_ages")
+parallel = importlib.import_module("5-parallel_scan")
+export = importlib.import_module("7-columnar_export")
+feed = importlib.import_module("8-change_feed")
+
+
+class GeneratorTestCase(unittest.TestCase):
+    """Points seed at a SQLite file in a temp directory, seeded with
+    `users` rows."""
+
+    users = 60
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.tmp.name, "users.db")
+        self.addCleanup(seed.use_backend, seed.BACKEND)
+        seed.use_backend(SQLiteBackend(self.database))
+        filename = os.path.join(self.tmp.name, "user_data.csv")
+        with open(filename, "w", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(("name", "email", "age"))
+            for index in range(self.users):
+                writer.writerow((f"User {index}",
+                                 f"user{index}@example.com", 18 + index % 50))
+        with seed.pooled_connection() as connection, \
+                contextlib.redirect_stdout(io.StringIO()):
+            seed.create_table(connection)
+            seed.insert_data(connection, filename)
+
+    def tearDown(self):
+        seed.get_pool().close()
+        self.tmp.cleanup()
+
+    def user_ids(self):
+        return sorted(seed.user_id_for(f"user{index}@example.com")
+                      for index in range(self.users))
+
+    def ages(self):
+        return [18 + index % 50 for index in range(self.users)]
+
+    def upsert(self, index, age):
+        email = f"user{index}@example.com"
+        with seed.pooled_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(seed.BACKEND.upsert_user_sql, (
+                seed.user_id_for(email), f"User {index}", email, age
+            ))
+            connection.commit()
+            cursor.close()
+
+    def updated_at(self, index):
+        # The raw text SQLite stores, without the TIMESTAMP converter.
+        connection = sqlite3.connect(self.database)
+        try:
+            return connection.execute(
+                "SELECT updated_at FROM user_data WHERE user_id = ?",
+                (seed.user_id_for(f"user{index}@example.com"),)
+            ).fetchone()[0]
+        finally:
+            connection.close()
+
+
+class TestSQLiteBackend(GeneratorTestCase):
+    """The shim speaks the mysql.connector subset the generators use."""
+
+    def test_cursor(self):
+        """%s placeholders bind; dictionary cursors return dicts."""
+        with seed.pooled_connection() as connection:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute(
+                "SELECT name, age FROM user_data WHERE email = %s;",
+                ("user3@example.com",)
+            )
+            self.assertEqual(cursor.fetchall(),
+                             [{"name": "User 3", "age": 21}])
+            cursor = connection.cursor()
+            cursor.execute("SELECT age FROM user_data ORDER BY age;")
+            self.assertEqual(cursor.fetchmany(2), [(18,), (18,)])
+            self.assertEqual(len(list(cursor)), self.users - 2)
+            cursor.close()
+
+    def test_timestamp_format(self):
+        """updated_at is stored as text that round-trips through
+        datetime and reads back as a datetime."""
+        stored = self.updated_at(0)
+        self.assertEqual(
+            datetime.fromisoformat(stored).isoformat(
+                " ", timespec="microseconds"
+            ), stored
+        )
+        with seed.pooled_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("SELECT updated_at FROM user_data LIMIT 1;")
+            self.assertIsInstance(cursor.fetchone()[0], datetime)
+            cursor.close()
+
+    def test_trigger_touches_changed_rows(self):
+        """The trigger bumps updated_at on a real change only."""
+        before = self.updated_at(0)
+        time.sleep(0.002)
+        self.upsert(0, 18)
+        self.assertEqual(self.updated_at(0), before)
+        self.upsert(0, 99)
+        self.assertGreater(self.updated_at(0), before)
+
+
+class TestPool(GeneratorTestCase):
+    """Released connections are reused; broken ones are discarded."""
+
+    def test_reuse(self):
+        """A released connection serves the next checkout."""
+        pool = seed.configure_pool(size=1, timeout=0.05)
+        with seed.pooled_connection() as first:
+            with self.assertRaises(seed.PoolExhausted):
+                pool.acquire()
+        with seed.pooled_connection() as second:
+            self.assertIs(first, second)
+        metrics = pool.metrics()
+        self.assertEqual((metrics["misses"], metrics["hits"]), (1, 1))
+
+    def test_error_discards(self):
+        """A connection that saw an error is closed, not reused."""
+        pool = seed.configure_pool(size=1)
+        with self.assertRaises(ValueError):
+            with seed.pooled_connection():
+                raise ValueError("failed")
+        self.assertEqual(pool.metrics()["discarded"], 1)
+        self.assertEqual(pool.metrics()["open"], 0)
+
+    def test_abandoned_stream(self):
+        """A stream closed early hands its connection back for reuse."""
+        pool = seed.configure_pool(size=1)
+        stream = stream_users(fetch_size=5)
+        next(stream)
+        stream.close()
+        self.assertEqual(pool.metrics()["idle"], 1)
+        self.assertEqual(pool.metrics()["discarded"], 0)
+
+
+class TestLazyPagination(GeneratorTestCase):
+    """Keyset pages resume from a token and stop their reader early."""
+
+    def test_pages(self):
+        """Pages cover every row in user_id order."""
+        pages = list(paginate.lazy_pagination(7))
+        self.assertEqual([len(page) for page in pages], [7] * 8 + [4])
+        self.assertEqual([row["user_id"] for page in pages for row in page],
+                         self.user_ids())
+
+    def test_resume_token(self):
+        """A token resumes after the page it was taken from."""
+        pages = paginate.lazy_pagination(10)
+        first = next(pages)
+        pages.close()
+        rest = paginate.lazy_pagination(
+            10, resume_token=paginate.page_token(first)
+        )
+        self.assertEqual([row["user_id"] for page in rest for row in page],
+                         self.user_ids()[10:])
+
+    def test_invalid_token(self):
+        """A malformed token raises ValueError."""
+        with self.assertRaises(ValueError):
+            next(paginate.lazy_pagination(10, resume_token="not a token"))
+
+    def test_read_ahead(self):
+        """Prefetched pages arrive in order."""
+        pages = paginate.lazy_pagination(7, prefetch=2)
+        self.assertEqual([row["user_id"] for page in pages for row in page],
+                         self.user_ids())
+
+    def test_read_ahead_cancellation(self):
+        """Closing early stops the reader and returns its connection."""
+        pool = seed.get_pool()
+        pages = paginate.lazy_pagination(1, prefetch=2)
+        next(pages)
+        started = threading.active_count()
+        pages.close()
+        self.assertEqual(threading.active_count(), started - 1)
+        self.assertEqual(pool.metrics()["idle"], pool.metrics()["open"])
+
+
+class TestAgeStatistics(GeneratorTestCase):
+    """The three strategies agree with each other and with Python."""
+
+    def test_strategies(self):
+        """sql, columnar and welford give the same summary."""
+        expected = self.ages()
+        results = {strategy: ages.age_statistics(strategy, bin_width=10)
+                   for strategy in ages.STRATEGIES}
+        for strategy, stats in results.items():
+            with self.subTest(strategy=strategy):
+                self.assertEqual(stats["count"], self.users)
+                self.assertTrue(math.isclose(
+                    stats["mean"], statistics.fmean(expected)
+                ))
+                self.assertTrue(math.isclose(
+                    stats["stddev"], statistics.pstdev(expected)
+                ))
+                self.assertEqual((stats["min"], stats["max"]), (18.0, 67.0))
+                self.assertEqual(stats["histogram"],
+                                 results["sql"]["histogram"])
+        self.assertEqual(results["columnar"]["percentiles"],
+                         results["sql"]["percentiles"])
+        self.assertEqual(results["welford"]["percentiles"], {})
+
+    def test_unknown_strategy(self):
+        """An unknown strategy raises ValueError."""
+        with self.assertRaises(ValueError):
+            ages.age_statistics("median")
+
+
+class TestChangeFeed(GeneratorTestCase):
+    """The watermark makes each run pick up where the last one stopped."""
+
+    def setUp(self):
+        super().setUp()
+        self.watermark = os.path.join(self.tmp.name, "watermark.json")
+
+    def changes(self):
+        return feed.stream_changes(self.watermark, batch_size=7, settle=0)
+
+    def test_watermark(self):
+        """A run sees only rows changed since the previous one."""
+        self.assertEqual(len(list(self.changes())), self.users)
+        self.assertEqual(list(self.changes()), [])
+        time.sleep(0.002)
+        self.upsert(5, 99)
+        changed, = self.changes()
+        self.assertEqual((changed["email"], changed["age"]),
+                         ("user5@example.com", 99))
+
+    def test_replays_unfinished_batch(self):
+        """Stopping mid-batch replays that batch on the next run."""
+        changes = self.changes()
+        seen = [next(changes)["user_id"] for _ in range(10)]
+        changes.close()
+        rest = [row["user_id"] for row in self.changes()]
+        self.assertEqual(rest[:3], seen[7:])
+        self.assertEqual(len(rest), self.users - 7)
+
+
+class TestColumnarExport(GeneratorTestCase):
+    """Exported columns read back as written."""
+
+    def test_round_trip(self):
+        """Every column reads back in export order, mapped or copied."""
+        path = os.path.join(self.tmp.name, "export")
+        self.assertEqual(export.export_users(path, batch_size=16),
+                         self.users)
+        with seed.pooled_connection() as connection:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute("SELECT * FROM user_data;")
+            rows = cursor.fetchall()
+            cursor.close()
+        self.assertEqual(export.read_meta(path)["rows"], self.users)
+        for use_mmap in (True, False):
+            with self.subTest(use_mmap=use_mmap):
+                for column in seed.USER_COLUMNS:
+                    values = export.read_column(path, column, use_mmap)
+                    self.assertEqual(
+                        [values[index] for index in range(len(values))],
+                        [row[column] for row in rows]
+                    )
+
+    def test_selected_columns(self):
+        """Only the requested columns are written."""
+        path = os.path.join(self.tmp.name, "export")
+        export.export_users(path, columns=("age",))
+        self.assertEqual(sorted(os.listdir(path)), ["age.bin", "meta.json"])
+        self.assertEqual(list(export.read_column(path, "age")),
+                         [float(age) for age in self.ages()])
+
+
+class TestParallelScan(GeneratorTestCase):
+    """Ranges are scanned in chunks on several workers at once."""
+
+    def scan(self, **kwargs):
+        return parallel.parallel_scan(
+            workers=2, partitions=2, executor="thread", chunk_size=4,
+            **kwargs
+        )
+
+    def test_ordered(self):
+        """ordered=True yields rows in user_id order."""
+        ids = [row["user_id"] for row in self.scan()]
+        self.assertEqual(ids, self.user_ids())
+
+    def test_unordered(self):
+        """ordered=False yields every row once."""
+        ids = [row["user_id"] for row in self.scan(ordered=False)]
+        self.assertCountEqual(ids, self.user_ids())
+
+    def test_filters(self):
+        """Python filters and column lists apply to every chunk."""
+        rows = list(self.scan(where=[parallel.is_over_25],
+                              columns=("age",)))
+        self.assertTrue(rows)
+        self.assertTrue(all(list(row) == ["age"] for row in rows))
+        self.assertEqual(len(rows), sum(
+            18 + index % 50 > 25 for index in range(self.users)
+        ))
+
+    def test_ranges_continue_concurrently(self):
+        """Later chunks of different ranges run on workers at once, even
+        while the consumer is still on the first range."""
+        scan_range = parallel.scan_range
+        lock = threading.Lock()
+        running = []
+        overlaps = []
+
+        def slow_scan_range(low, high, where, columns, after, limit):
+            if after is None:
+                return scan_range(low, high, where, columns, after, limit)
+            with lock:
+                running.append(low)
+                overlaps.append(len(running))
+            try:
+                time.sleep(0.01)
+                return scan_range(low, high, where, columns, after, limit)
+            finally:
+                with lock:
+                    running.remove(low)
+
+        with patch.object(parallel, "scan_range", slow_scan_range):
+            ids = [row["user_id"] for row in self.scan()]
+        self.assertEqual(ids, self.user_ids())
+        self.assertGreater(max(overlaps), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()